@@ -1,11 +1,16 @@
 import app_config
 import app_utils
 import datetime
+import json
 import logging
+import metrics
+import notifications
+import queue
 import static
+import time
 
-from app_utils import comma_filter, percent_filter, open_db, close_db, never_cache_preview
-from flask import Flask, make_response, render_template
+from app_utils import SLUG_TO_OFFICENAME, comma_filter, percent_filter, open_db, close_db, never_cache_preview
+from flask import Flask, Response, g, jsonify, make_response, render_template, request
 from flask_admin import Admin
 from flask_admin.contrib.peewee import ModelView
 from models import models
@@ -41,28 +46,12 @@ admin.add_view(ModelView(models.Result))
 admin.add_view(ModelView(models.Call))
 admin.add_view(ModelView(models.RaceMeta))
 
-SLUG_TO_OFFICENAME = {
-    'senate': 'U.S. Senate',
-    'house': 'U.S. House',
-    'governor': 'Governor'
-}
-
 
 @app.route('/%s/calls/<office>/' % app_config.PROJECT_SLUG, methods=['GET'])
 def calls_admin(office):
     officename = SLUG_TO_OFFICENAME[office]
 
-    # This value will be the same for all seats in a chamber, so pick
-    # an arbitrary one
-    chamber_call_override = models.RaceMeta.select(
-        models.RaceMeta.chamber_call_override
-    ).join(
-        models.Result
-    ).where(
-        models.Result.officename == SLUG_TO_OFFICENAME[office]
-    ).scalar()
-
-    results = app_utils.get_results(officename)
+    results, version = app_utils.results_cache.get_versioned(officename)
 
     if not results:
         # Occasionally, the database will erroneously return zero races
@@ -70,17 +59,94 @@ def calls_admin(office):
         # See https://github.com/nprapps/elections18-general/issues/24
         return 'Server error; failed to fetch results from database', 500
 
+    chamber_call_override = _chamber_call_override(results)
+
     context = make_context(asset_depth=1)
     context.update({
         'officename': officename,
         'chamber_call_override': chamber_call_override,
         'offices': SLUG_TO_OFFICENAME,
-        'races': results
+        'races': results,
+        'version': version
     })
 
     return make_response(render_template('calls.html', **context))
 
 
+def _chamber_call_override(results):
+    """
+    The override is the same for every seat in a chamber, but races
+    without race metadata don't have it, so take the first one found
+    """
+    for race in results.values():
+        for result in race:
+            if result['chamber_call_override'] is not None:
+                return result['chamber_call_override']
+    return None
+
+
+@app.route('/%s/calls/<office>/changes' % app_config.PROJECT_SLUG, methods=['GET'])
+def calls_changes(office):
+    '''
+    Return markup for only the races that changed since the version
+    passed as `since`, so the calls page can patch itself in place
+    '''
+    officename = SLUG_TO_OFFICENAME[office]
+
+    version, results, changed = app_utils.results_cache.changes(officename, request.args.get('since'))
+
+    if not results:
+        return 'Server error; failed to fetch results from database', 500
+
+    return jsonify({
+        'version': version,
+        'chamber_call_override': _chamber_call_override(results),
+        'races': {
+            raceid: render_template('_race.html', results=results[raceid])
+            for raceid in changed
+        }
+    })
+
+
+@app.route('/%s/calls/<office>/events' % app_config.PROJECT_SLUG, methods=['GET'])
+def calls_events(office):
+    '''
+    A server-sent events stream that announces new results and calls,
+    so that open calls pages know when to fetch changes
+    '''
+    officename = SLUG_TO_OFFICENAME[office]
+
+    def stream():
+        subscriber = notifications.listener.subscribe()
+        try:
+            yield 'retry: 5000\n\n'
+
+            end = time.time() + app_config.EVENTS_STREAM_DURATION
+            while time.time() < end:
+                try:
+                    event = subscriber.get(timeout=app_config.EVENTS_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+
+                if event.get('officename') not in (None, officename):
+                    continue
+
+                # The change may have come from the daemon or another
+                # app process, so don't wait out the cache's TTL
+                app_utils.results_cache.invalidate(officename)
+
+                yield 'event: {0}\ndata: {1}\n\n'.format(event['type'], json.dumps(event))
+        finally:
+            notifications.listener.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Don't let nginx buffer the stream
+        'X-Accel-Buffering': 'no'
+    })
+
+
 @app.route('/%s/calls/<office>/call-chamber' % app_config.PROJECT_SLUG, methods=['POST'])
 def call_chamber(office):
     '''
@@ -97,49 +163,70 @@ def call_chamber(office):
     update = models.RaceMeta.update(chamber_call_override=call).where(models.RaceMeta.result_id_id << result_ids_for_chamber)
     update.execute()
 
+    app_utils.results_cache.invalidate(SLUG_TO_OFFICENAME[office])
+    notifications.publish('calls', officename=SLUG_TO_OFFICENAME[office])
+
     return 'Success', 200
 
 
+def _race_response(officename, raceid):
+    """
+    Markup for a race as it stands after a call, so the page can patch
+    it without waiting for its next refresh
+    """
+    app_utils.results_cache.invalidate(officename)
+    results = app_utils.get_results(officename, raceid=raceid)
+
+    return jsonify({
+        'races': {
+            raceid: render_template('_race.html', results=race_results)
+            for raceid, race_results in results.items()
+        }
+    })
+
+
 @app.route('/%s/calls/<office>/call-npr' % app_config.PROJECT_SLUG, methods=['POST'])
 def call_npr(office):
     from flask import request
 
     result_id = request.form.get('result_id')
 
-    result = models.Result.get(models.Result.id == result_id)
-    call = result.call[0]
-    if call.override_winner:
-        call.override_winner = False
-    else:
-        call.override_winner = True
-
-    call.save()
-
-    race_id = result.raceid
-    statepostal = result.statepostal
-    officename = result.officename
-    level = result.level
-    reportingunitname = result.reportingunitname
+    with models.db.atomic():
+        result = models.Result.get(models.Result.id == result_id)
 
-    race_results = models.Result.select().where(
-        models.Result.level == level,
-        models.Result.raceid == race_id,
-        models.Result.officename == officename,
-        models.Result.statepostal == statepostal,
-        models.Result.reportingunitname == reportingunitname
-    )
-
-    for race_result in race_results:
-        race_call = race_result.call[0]
-        if call.override_winner:
-            race_call.accept_ap = False
+        race_result_ids = models.Result.select(models.Result.id).where(
+            models.Result.level == result.level,
+            models.Result.raceid == result.raceid,
+            models.Result.officename == result.officename,
+            models.Result.statepostal == result.statepostal,
+            models.Result.reportingunitname == result.reportingunitname
+        )
 
-        if race_call.call_id != call.call_id:
-            race_call.override_winner = False
+        # Lock the race's calls, so that editors clicking on the same
+        # race at once have their calls applied one after the other
+        overrides = {
+            call['call_id']: call['override_winner']
+            for call in models.Call.select(
+                models.Call.call_id,
+                models.Call.override_winner
+            ).where(
+                models.Call.call_id << race_result_ids
+            ).order_by(
+                models.Call.id
+            ).for_update().dicts()
+        }
+
+        # A race has at most one NPR winner, and calling it means no
+        # longer accepting AP's call
+        if not overrides[result.id]:
+            update = models.Call.update(override_winner=(models.Call.call_id == result.id), accept_ap=False)
+        else:
+            update = models.Call.update(override_winner=False)
+        update.where(models.Call.call_id << race_result_ids).execute()
 
-        race_call.save()
+        notifications.publish('calls', officename=result.officename, statepostal=result.statepostal)
 
-    return 'Success', 200
+    return _race_response(result.officename, result.raceid)
 
 
 @app.route('/%s/calls/<office>/accept-ap' % app_config.PROJECT_SLUG, methods=['POST'])
@@ -154,7 +241,7 @@ def accept_ap(office):
     level = request.form.get('level')
 
     if level == 'district':
-        results = models.Result.select().where(
+        race_result_ids = models.Result.select(models.Result.id).where(
             models.Result.level == 'district',
             models.Result.raceid == race_id,
             models.Result.officename == officename,
@@ -162,22 +249,42 @@ def accept_ap(office):
             models.Result.reportingunitname == reportingunit
         )
     else:
-        results = models.Result.select().where(
+        race_result_ids = models.Result.select(models.Result.id).where(
             (models.Result.level == 'state') | (models.Result.level == 'national'),
             models.Result.raceid == race_id,
             models.Result.officename == officename,
             models.Result.statepostal == statepostal,
         )
 
-    for result in results:
-        call = result.call[0]
-        if call.accept_ap:
-            call.accept_ap = False
-        else:
-            call.accept_ap = True
-        call.save()
+    with models.db.atomic():
+        models.Call.update(
+            accept_ap=~models.Call.accept_ap
+        ).where(
+            models.Call.call_id << race_result_ids
+        ).execute()
 
-    return 'Success', 200
+        notifications.publish('calls', officename=officename, statepostal=statepostal)
+
+    return _race_response(officename, race_id)
+
+
+@app.route('/%s/metrics' % app_config.PROJECT_SLUG, methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus-style metrics for the daemon's last saved snapshot and
+    for all of the app's workers.
+    """
+    for name, value in models.db.pool_stats().items():
+        metrics.set_gauge('db_pool_' + name, value)
+    metrics.save_worker_snapshot(force=True)
+
+    output = ''
+    daemon_snapshot = metrics.load_snapshot()
+    if daemon_snapshot:
+        output += metrics.to_prometheus(daemon_snapshot, process='daemon')
+    output += metrics.to_prometheus(metrics.merge_workers(metrics.load_worker_snapshots()), process='app')
+
+    return make_response(output, 200, {'Content-Type': 'text/plain; version=0.0.4'})
 
 
 @app.route('/%s/test/' % app_config.PROJECT_SLUG, methods=['GET'])
@@ -190,14 +297,50 @@ def _test_app():
     return make_response(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
 
+def start_request_timer():
+    g.request_start = time.time()
+
+
+def record_request_timer(response):
+    if hasattr(g, 'request_start'):
+        metrics.observe('request', time.time() - g.request_start, endpoint=request.endpoint or 'unknown')
+        metrics.increment('responses', status=response.status_code)
+        metrics.save_worker_snapshot()
+    return response
+
+
+try:
+    import uwsgi
+    # Workers are forked from the uwsgi master after it loads the app,
+    # and must not share its database connections
+    uwsgi.post_fork_hook = models.db.reset_after_fork
+except ImportError:
+    pass
+
+# Workers are forked after this, so only the previous run's saved
+# metrics are cleared
+metrics.clear_worker_snapshots()
+
+app.before_request(start_request_timer)
 app.before_request(open_db)
-app.after_request(close_db)
+app.teardown_request(close_db)
 app.after_request(never_cache_preview)
+app.after_request(record_request_timer)
 
 # Enable Werkzeug debug pages, and add a performance profiler
 if app_config.DEBUG:
     app.config['PROFILE'] = True
-    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[10])
+    profiled_wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[10])
+    unprofiled_wsgi_app = app.wsgi_app
+
+    def _debug_wsgi_app(environ, start_response):
+        # The profiler buffers whole responses, which would hold back
+        # every event on an events stream until it closed
+        if environ.get('PATH_INFO', '').endswith('/events'):
+            return unprofiled_wsgi_app(environ, start_response)
+        return profiled_wsgi_app(environ, start_response)
+
+    app.wsgi_app = _debug_wsgi_app
     wsgi_app = DebuggedApplication(app, evalex=False)
 else:
     wsgi_app = app
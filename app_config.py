@@ -74,7 +74,8 @@ SERVER_SERVICES = [
     ('app', SERVER_REPOSITORY_PATH, 'ini'),
     ('uwsgi', '/etc/init', 'conf'),
     ('nginx', '/etc/nginx/sites-enabled', 'conf'),
-    ('fetch_and_publish_results', '/etc/init', 'conf')
+    ('fetch_and_publish_results', '/etc/init', 'conf'),
+    ('render_and_publish_calls', '/etc/init', 'conf')
 ]
 
 # These variables will be set at runtime. See configure_targets() below
@@ -143,19 +144,87 @@ elex config; see the `Configuration` section of `README.md`
 """
 NEXT_ELECTION_DATE = '2018-11-06'
 # We need to make a single call in order to be compatible with our
-# testing server. Ideally we'd have two calls, with House and Initiative
-# data being requested at the race-wide level, to minimize data-over-the-wire.
+# testing server. Production and staging make two calls at once, with
+# House and Initiative data being requested at the race-wide level, to
+# minimize data-over-the-wire; see `configure_targets`
 ELEX_FLAG_SETS = [
     '--results-level ru --officeids H,S,G,I'
 ]
 ELEX_INIT_FLAG_SETS = [
     '--results-level ru --officeids H,S,G,I --set-zero-counts'
 ]
+SPLIT_ELEX_FLAG_SETS = [
+    '--results-level ru --officeids S,G',
+    '--results-level state --officeids H,I'
+]
+SPLIT_ELEX_INIT_FLAG_SETS = [
+    '--results-level ru --officeids S,G --set-zero-counts',
+    '--results-level state --officeids H,I --set-zero-counts'
+]
 ELEX_FTP_FLAGS = ''
 
+# Every flag set's fetch has to finish within this many seconds of the
+# first one starting, and each gets this many tries
+ELEX_FETCH_TIMEOUT = 60
+ELEX_FETCH_ATTEMPTS = 2
+
 LOAD_RESULTS_INTERVAL = 12
+
+# Results are loaded into a shadow table, then swapped in for the live one.
+# The swap waits this many seconds for queries reading the live table to
+# finish before giving up and trying again; if every attempt fails, the
+# previous results are kept until the next load
+RESULTS_SWAP_LOCK_TIMEOUT = 2
+RESULTS_SWAP_ATTEMPTS = 3
+
+# Optionally split the results table into Postgres partitions by level, so
+# that queries for statewide results only read statewide rows; levels that
+# aren't listed go to an `other` partition. Needs Postgres 11 or later.
+# Calls and race metadata lose their foreign keys to results while it's on,
+# since Postgres can't reference a partitioned table's IDs on their own
+RESULT_PARTITIONS = None
+# RESULT_PARTITIONS = {
+#     'statewide': ['national', 'state', 'district'],
+#     'county': ['county']
+# }
+
+# The daemon refreshes Google Sheets in the background, on its own
+# schedule; downloads taking longer than the timeout are abandoned, and
+# the last complete copy is used until the next attempt
+SHEETS_REFRESH_INTERVAL = 30
+SHEETS_REFRESH_TIMEOUT = 60
+
 DATA_OUTPUT_FOLDER = '.rendered'
 
+# Timing and counter snapshot written by the daemon after each cycle,
+# and served by the admin app at `/metrics`
+METRICS_PATH = 'logs/daemon-metrics.json'
+
+# Number of processes that render state files; `None` sizes the pool
+# automatically, from how much time renders spend waiting on Postgres
+RENDER_WORKERS = None
+
+# Calls made in the admin are rendered and published as they're made,
+# by a separate daemon, which renders into its own folder
+CALLS_DATA_OUTPUT_FOLDER = '.rendered-calls'
+
+# Seconds that daemon waits for more calls, so a burst of clicks is
+# rendered and published once
+CALLS_RENDER_DELAY = 0.5
+
+# Held by either daemon while it renders and uploads, so that a results
+# cycle rendered before a call can't upload over that call's files
+PUBLISH_LOCK_PATH = 'logs/publish.lock'
+
+# `fab data.get_census_data` asks Census Reporter for several counties per
+# request, from a few threads, while staying under the rate limit. Each
+# county's response is cached here, so an interrupted run can resume
+CENSUS_REPORTER_URL = 'https://api.censusreporter.org/1.0/data/show/acs2016_5yr'
+CENSUS_CACHE_PATH = 'data/census/cache'
+CENSUS_BATCH_SIZE = 25
+CENSUS_WORKERS = 4
+CENSUS_REQUESTS_PER_SECOND = 2
+
 CANDIDATE_SET_OVERRIDES = {
     # Alaska governor: Dunleavy, Begich, and Walker
     '2010': ['6733', '6731', '6399'],
@@ -182,6 +251,56 @@ PARTY_OVERRIDES = {
     ]
 }
 
+"""
+Database connection pool
+"""
+# These limits apply to each process separately; render workers and
+# app workers all keep their own pool
+DATABASE_MAX_CONNECTIONS = 8
+# Recycle pooled connections after this many seconds
+DATABASE_STALE_TIMEOUT = 300
+# Seconds to wait for a free pooled connection before giving up
+DATABASE_POOL_TIMEOUT = 10
+
+"""
+Admin app
+"""
+# Seconds that the calls pages may reuse a query of an office's results;
+# any call made in the admin clears that office's cached results
+CALLS_CACHE_TTL = 5
+
+# Compiled LESS and JST output is cached here, and only recompiled
+# when its sources change
+STATIC_CACHE_FOLDER = '.static-cache'
+
+# Name of the uwsgi cache that app workers share cached results through
+ADMIN_CACHE_NAME = 'admin'
+
+# Processes and threads per process that serve the admin app, under
+# both uwsgi and `fab app:production=true`
+ADMIN_WORKERS = 4
+ADMIN_THREADS = 16
+# Each thread holds a pooled connection for the length of its request,
+# so an app worker's pool needs at least one connection per thread
+DATABASE_MAX_CONNECTIONS = max(DATABASE_MAX_CONNECTIONS, ADMIN_THREADS)
+
+# Calls pages listen for changes on a server-sent events stream. Each
+# stream is closed after this many seconds, and the browser reconnects;
+# keep it below uwsgi's `harakiri` timeout
+EVENTS_STREAM_DURATION = 90
+
+# Seconds between keep-alive comments on an idle events stream
+EVENTS_HEARTBEAT_INTERVAL = 15
+
+"""
+SQL profiling
+"""
+# Count queries per calling function and report the slowest statements
+# with their query plans, once per daemon cycle; see `models/profiler.py`
+SQL_PROFILE = os.environ.get('SQL_PROFILE', '').lower() in ('1', 'true', 'yes')
+SQL_PROFILE_SLOWEST_COUNT = 10
+SQL_PROFILE_PATH = 'logs/sql-profile.txt'
+
 """
 Utilities
 """
@@ -218,6 +337,8 @@ def configure_targets(deployment_target):
     global NEXT_ELECTION_DATE
     global ELEX_FLAGS
     global ELEX_INIT_FLAGS
+    global ELEX_FLAG_SETS
+    global ELEX_INIT_FLAG_SETS
     global LOAD_RESULTS_INTERVAL
     global ELEX_OUTPUT_FOLDER
 
@@ -247,6 +368,8 @@ def configure_targets(deployment_target):
         ASSETS_MAX_AGE = 20
         LOAD_RESULTS_INTERVAL = 10
         ELEX_OUTPUT_FOLDER = '.data'
+        ELEX_FLAG_SETS = SPLIT_ELEX_FLAG_SETS
+        ELEX_INIT_FLAG_SETS = SPLIT_ELEX_INIT_FLAG_SETS
     elif deployment_target == 'staging':
         S3_BUCKET = STAGING_S3_BUCKET
         S3_BASE_URL = 'http://%s/%s' % (S3_BUCKET, PROJECT_SLUG)
@@ -259,6 +382,8 @@ def configure_targets(deployment_target):
         ASSETS_MAX_AGE = 20
         LOAD_RESULTS_INTERVAL = 10
         ELEX_OUTPUT_FOLDER = '.data'
+        ELEX_FLAG_SETS = SPLIT_ELEX_FLAG_SETS
+        ELEX_INIT_FLAG_SETS = SPLIT_ELEX_INIT_FLAG_SETS
     elif deployment_target == 'test':
         S3_BUCKET = STAGING_S3_BUCKET
         S3_BASE_URL = 'http://%s/%s' % (S3_BUCKET, PROJECT_SLUG)
@@ -1,33 +1,373 @@
+import app_config
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+import zlib
+
 from collections import OrderedDict
+from contextlib import contextmanager
 from decimal import Decimal, ROUND_DOWN
 from models import models
+from peewee import JOIN
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+# The offices that have calls pages, by their slug in the admin's URLs
+SLUG_TO_OFFICENAME = {
+    'senate': 'U.S. Senate',
+    'house': 'U.S. House',
+    'governor': 'Governor'
+}
+
 
+def get_results(name, raceid=None):
+    """
+    Fetch the results, calls and race metadata for an office in a single
+    query, grouped by race. Pass `raceid` to fetch just that race.
+    """
+    clauses = [
+        (models.Result.level == 'state') | (models.Result.level == 'national') | (models.Result.level == 'district'),
+        models.Result.officename == name
+    ]
+    if raceid is not None:
+        clauses.append(models.Result.raceid == raceid)
 
-def get_results(name):
     results = models.Result.select(
         models.Result,
         models.Call.accept_ap,
-        models.Call.override_winner
+        models.Call.override_winner,
+        models.RaceMeta.chamber_call_override
+    ).join(
+        models.Call,
+        on=(models.Call.call_id == models.Result.id)
+    ).switch(
+        models.Result
+    ).join(
+        models.RaceMeta,
+        JOIN.LEFT_OUTER,
+        on=(models.RaceMeta.result_id == models.Result.id)
     ).where(
-        (models.Result.level == 'state') | (models.Result.level == 'national') | (models.Result.level == 'district'),
-        models.Result.officename == name
+        *clauses
     ).order_by(
         models.Result.statepostal,
         models.Result.seatname,
         -models.Result.votecount,
         models.Result.last
-    ).join(
-        models.Call,
-        on=(models.Call.call_id == models.Result.id)
     ).dicts()
 
     grouped = OrderedDict()
     for result in results:
-        grouped[result['raceid']] = grouped.get(result['raceid'], []) + [result]
+        race = grouped.get(result['raceid'])
+        if race is None:
+            race = grouped[result['raceid']] = []
+        race.append(result)
 
     return grouped
 
 
+def _race_digest(race):
+    return hashlib.md5(repr(race).encode('utf-8')).hexdigest()
+
+
+class LocalStore(object):
+    """
+    Values shared by the threads of one process.
+    """
+    def __init__(self):
+        self._values = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def set(self, key, value):
+        self._values[key] = value
+
+    def add(self, key, value):
+        """
+        Set `key` only if it isn't set yet, and return its value.
+        """
+        with self._lock:
+            return self._values.setdefault(key, value)
+
+    @contextmanager
+    def lock(self, name):
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            yield
+
+
+class UwsgiStore(object):
+    """
+    Values shared by every uwsgi worker, kept in a uwsgi `cache2`.
+
+    Names are locked with one of uwsgi's shared `locks`, so different
+    names only contend when they share a lock.
+    """
+    def __init__(self, cache_name):
+        self.cache_name = cache_name
+        self.locks = int(uwsgi.opt.get('locks', 0))
+
+    def get(self, key):
+        value = uwsgi.cache_get(key, self.cache_name)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        if not uwsgi.cache_update(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), 0, self.cache_name):
+            logger.warning('could not store {0} in the {1} uwsgi cache'.format(key, self.cache_name))
+
+    def add(self, key, value):
+        """
+        Set `key` only if it isn't set yet, and return its value.
+        """
+        uwsgi.cache_set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), 0, self.cache_name)
+        return self.get(key)
+
+    @contextmanager
+    def lock(self, name):
+        # uwsgi has lock 0, plus one for each of `locks`
+        number = zlib.crc32(name.encode('utf-8')) % (self.locks + 1)
+        uwsgi.lock(number)
+        try:
+            yield
+        finally:
+            uwsgi.unlock(number)
+
+
+def get_shared_store():
+    """
+    Share cached values between workers when running under uwsgi with
+    the admin cache configured, and within this process otherwise.
+    """
+    if uwsgi is not None and 'cache2' in uwsgi.opt:
+        return UwsgiStore(app_config.ADMIN_CACHE_NAME)
+    return LocalStore()
+
+
+class ResultsCache(object):
+    """
+    Short-lived cache of `get_results`, so that editors refreshing the
+    same calls page share a single query. Making a call clears the
+    office's entry.
+
+    Each refetch is compared race-by-race with the previous one, and
+    changed races are stamped with a new version number, so that pages
+    can ask for only the races that changed since the version they have.
+    Versions are only meaningful within the same `epoch`.
+
+    Everything is kept in `store`, so that app workers sharing a store
+    share their queries and version numbers too. Each process keeps its
+    own copy of the latest results, and only reloads them from the store
+    when their version changes.
+
+    An office's lock is only held to read its entry, to claim a refetch
+    and to save the refetched results; the query itself runs unlocked,
+    while other requests are served the previous results. After a call
+    is made, other requests wait for the refetch instead, so that every
+    page sees the call.
+    """
+    # Seconds after which another request may take over a claimed
+    # refetch, in case the one that claimed it failed
+    refresh_timeout = 30
+
+    # Seconds between checks on another request's refetch, when its
+    # results have to be waited for
+    wait_interval = 0.05
+
+    def __init__(self, ttl, store=None, fetch=None):
+        self.ttl = ttl
+        self.store = store if store is not None else get_shared_store()
+        self.fetch = fetch
+        self._local_results = {}
+
+    def get(self, name):
+        return self.get_versioned(name)[0]
+
+    def get_versioned(self, name):
+        """
+        Return an office's grouped results, and the version token that
+        describes them.
+        """
+        office, results = self._refresh(name)
+        return results, self._token(office['version'])
+
+    def changes(self, name, since=None):
+        """
+        Return the version token, the grouped results, and the IDs of the
+        races that changed after the `since` token. All races count as
+        changed if `since` is missing or from another epoch.
+        """
+        office, results = self._refresh(name)
+        token = self._token(office['version'])
+        since_version = self._parse_token(since)
+
+        if since_version is None:
+            return token, results, list(results.keys())
+
+        changed = [
+            raceid for raceid in results
+            if office['race_versions'].get(raceid, 0) > since_version
+        ]
+        return token, results, changed
+
+    def invalidate(self, name=None):
+        names = (self.store.get('offices') or []) if name is None else [name]
+        for office_name in names:
+            with self.store.lock(office_name):
+                office = self.store.get(self._key(office_name))
+                if office:
+                    # Any refetch already under way may have missed the
+                    # change, so the next request starts another
+                    office.update({
+                        'fetched': 0,
+                        'claimed': 0,
+                        'invalidated': time.time()
+                    })
+                    self.store.set(self._key(office_name), office)
+
+    @property
+    def epoch(self):
+        epoch = self.store.get('epoch')
+        if epoch is None:
+            epoch = self.store.add('epoch', '{:x}.{:x}'.format(int(time.time() * 1000), os.getpid()))
+        return epoch
+
+    def _key(self, name, part='office'):
+        return 'results-cache:{0}:{1}'.format(part, name)
+
+    def _refresh(self, name):
+        while True:
+            with self.store.lock(name):
+                office = self.store.get(self._key(name))
+                is_new = office is None
+                if is_new:
+                    office = self._new_office()
+
+                results = self._load_results(name, office['version'])
+                refetching = time.time() - office['claimed'] < self.refresh_timeout
+                if results is not None:
+                    if time.time() - office['fetched'] < self.ttl:
+                        return office, results
+                    # Someone else is already refetching. The previous
+                    # results will do if they've only expired, but not if
+                    # they're from before a call was made
+                    if refetching and office['invalidated'] <= office['saved']:
+                        return office, results
+
+                if not (refetching and results is not None):
+                    claimed = office['claimed'] = time.time()
+                    self.store.set(self._key(name), office)
+                    break
+
+            # Wait for the refetch to be saved, or given up on
+            time.sleep(self.wait_interval)
+
+        if is_new:
+            self._add_office(name)
+
+        try:
+            fetched = (self.fetch or get_results)(name)
+            digests = {raceid: _race_digest(race) for raceid, race in fetched.items()}
+        except Exception:
+            with self.store.lock(name):
+                office = self.store.get(self._key(name)) or office
+                if office['claimed'] == claimed:
+                    office['claimed'] = 0
+                    self.store.set(self._key(name), office)
+            raise
+
+        with self.store.lock(name):
+            office = self.store.get(self._key(name)) or office
+            if office['claimed'] == claimed:
+                office['claimed'] = 0
+
+            # A refetch claimed after this one has already been saved
+            if office['saved'] > claimed:
+                self.store.set(self._key(name), office)
+                results = self._load_results(name, office['version'])
+                return office, results if results is not None else fetched
+
+            # Don't hold on to an empty result set; see `calls_admin`
+            if not fetched:
+                self.store.set(self._key(name), office)
+                return office, fetched
+
+            changed = [raceid for raceid, digest in digests.items() if office['digests'].get(raceid) != digest]
+            if changed:
+                office['version'] += 1
+                for raceid in changed:
+                    office['race_versions'][raceid] = office['version']
+
+            office.update({
+                # Results fetched before the office was invalidated are
+                # saved, but not reused
+                'fetched': time.time() if office['invalidated'] < claimed else 0,
+                'saved': claimed,
+                'digests': digests
+            })
+            self.store.set(self._key(name, 'results'), fetched)
+            self.store.set(self._key(name), office)
+            self._local_results[name] = (self.epoch, office['version'], fetched)
+
+            return office, fetched
+
+    def _new_office(self):
+        return {
+            'fetched': 0,
+            'claimed': 0,
+            'saved': 0,
+            'invalidated': 0,
+            'digests': {},
+            'race_versions': {},
+            'version': 0
+        }
+
+    def _add_office(self, name):
+        # So that `invalidate` can find every office
+        with self.store.lock('offices'):
+            offices = self.store.get('offices') or []
+            if name not in offices:
+                self.store.set('offices', offices + [name])
+
+    def _load_results(self, name, version):
+        epoch = self.epoch
+        local_epoch, local_version, results = self._local_results.get(name, (None, None, None))
+        if (local_epoch, local_version) != (epoch, version):
+            results = self.store.get(self._key(name, 'results'))
+            if results is not None:
+                self._local_results[name] = (epoch, version, results)
+        return results
+
+    def _token(self, version):
+        return '{0}-{1}'.format(self.epoch, version)
+
+    def _parse_token(self, token):
+        try:
+            epoch, version = token.split('-')
+            if epoch == self.epoch:
+                return int(version)
+        except (AttributeError, ValueError):
+            pass
+        return None
+
+
+results_cache = ResultsCache(app_config.CALLS_CACHE_TTL)
+
+
 def comma_filter(value):
     """
     Format a number with commas.
@@ -58,21 +398,24 @@ def never_cache_preview(response):
     response.cache_control.max_age = 0
     response.cache_control.no_cache = True
     response.cache_control.must_revalidate = True
-    response.cache_control.no_store = True
+
+    # Responses with an ETag may be stored, since they're revalidated
+    if not response.get_etag()[0]:
+        response.cache_control.no_store = True
     return response
 
 
 def open_db():
     """
-    Open db connection
+    Check a db connection out of the pool
     """
-    if models.db._local.closed:
+    if models.db.is_closed():
         models.db.connect()
 
 
-def close_db(response):
+def close_db(exception=None):
     """
-    Close db connection
+    Return the db connection to the pool, even if the request failed
     """
-    models.db.close()
-    return response
+    if not models.db.is_closed():
+        models.db.close()
@@ -2,6 +2,7 @@
 # _*_ coding:utf-8 _*_
 
 import logging
+import metrics
 import os
 
 from fabric.api import local, require, settings, task
@@ -11,10 +12,13 @@ from termcolor import colored
 import app_config
 
 # Other fabfiles
+from . import benchmark
 from . import daemons
 from . import data
 from . import issues
+from . import loadtest
 from . import render
+from . import replay
 from . import text
 from . import utils
 
@@ -101,14 +105,23 @@ def branch(branch_name):
 Running the app
 """
 @task
-def app(port='8000'):
+def app(port='8000', production='false'):
     """
-    Serve app.py.
+    Serve app.py. Pass `production=true` to serve it with several
+    preloaded workers, and without reloading on changes.
     """
+    if production == 'true':
+        options = '--workers {0} --threads {1} --preload --timeout 120 --max-requests 5000'.format(
+            app_config.ADMIN_WORKERS,
+            app_config.ADMIN_THREADS
+        )
+    else:
+        options = '--threads 8 --timeout 3600 --reload'
+
     if env.get('settings'):
-        local("DEPLOYMENT_TARGET=%s bash -c 'gunicorn -b 0.0.0.0:%s --timeout 3600 --reload --log-file=logs/app.log app:wsgi_app'" % (env.settings, port))
+        local("DEPLOYMENT_TARGET=%s bash -c 'gunicorn -b 0.0.0.0:%s %s --log-file=logs/app.log app:wsgi_app'" % (env.settings, port, options))
     else:
-        local('gunicorn -b 0.0.0.0:%s --timeout 3600 --reload --log-file=- app:wsgi_app' % port)
+        local('gunicorn -b 0.0.0.0:%s %s --log-file=- app:wsgi_app' % (port, options))
 
 
 @task
@@ -129,6 +142,14 @@ code to a remote server if required.
 @task
 def publish_results():
     render.render_all()
+    publish_rendered_data()
+
+
+@task
+def publish_rendered_data():
+    """
+    Publish whatever is in the data output folder, without rendering.
+    """
     if env.get('settings'):
         sync_s3()
     elif os.path.isdir(app_config.GRAPHICS_DATA_OUTPUT_FOLDER):
@@ -139,11 +160,12 @@ def publish_results():
 
 @task
 def sync_s3():
-    local('aws s3 sync {0} s3://{1}/{2}/data/ --acl public-read --cache-control max-age=5'.format(
-        app_config.DATA_OUTPUT_FOLDER,
-        app_config.S3_BUCKET,
-        app_config.PROJECT_SLUG
-    ))
+    with metrics.timer('stage', stage='s3_sync'):
+        local('aws s3 sync {0} s3://{1}/{2}/data/ --acl public-read --cache-control max-age=5'.format(
+            app_config.DATA_OUTPUT_FOLDER,
+            app_config.S3_BUCKET,
+            app_config.PROJECT_SLUG
+        ))
 
 
 """
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the results pipeline against synthetic elections, loaded
+into the local Postgres database.
+"""
+
+import app_config
+import app_utils
+import csv
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from datetime import datetime
+from fabric.api import task
+from models import models
+
+from . import data
+from . import render
+from . import utils
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+STATES = [
+    ('AL', 'Alabama'), ('AK', 'Alaska'), ('AZ', 'Arizona'), ('AR', 'Arkansas'),
+    ('CA', 'California'), ('CO', 'Colorado'), ('CT', 'Connecticut'), ('DE', 'Delaware'),
+    ('FL', 'Florida'), ('GA', 'Georgia'), ('HI', 'Hawaii'), ('ID', 'Idaho'),
+    ('IL', 'Illinois'), ('IN', 'Indiana'), ('IA', 'Iowa'), ('KS', 'Kansas'),
+    ('KY', 'Kentucky'), ('LA', 'Louisiana'), ('ME', 'Maine'), ('MD', 'Maryland'),
+    ('MA', 'Massachusetts'), ('MI', 'Michigan'), ('MN', 'Minnesota'), ('MS', 'Mississippi'),
+    ('MO', 'Missouri'), ('MT', 'Montana'), ('NE', 'Nebraska'), ('NV', 'Nevada'),
+    ('NH', 'New Hampshire'), ('NJ', 'New Jersey'), ('NM', 'New Mexico'), ('NY', 'New York'),
+    ('NC', 'North Carolina'), ('ND', 'North Dakota'), ('OH', 'Ohio'), ('OK', 'Oklahoma'),
+    ('OR', 'Oregon'), ('PA', 'Pennsylvania'), ('RI', 'Rhode Island'), ('SC', 'South Carolina'),
+    ('SD', 'South Dakota'), ('TN', 'Tennessee'), ('TX', 'Texas'), ('UT', 'Utah'),
+    ('VT', 'Vermont'), ('VA', 'Virginia'), ('WA', 'Washington'), ('WV', 'West Virginia'),
+    ('WI', 'Wisconsin'), ('WY', 'Wyoming')
+]
+
+# The AP reports these states' results by township as well as by county
+NEW_ENGLAND = ['CT', 'MA', 'ME', 'NH', 'RI', 'VT']
+
+PARTIES = ['Dem', 'GOP', 'Lib', 'Grn', 'Ind']
+
+STAGES = ['load', 'create_calls', 'create_race_meta', 'render', 'get_results']
+
+
+class SyntheticElection(object):
+    """
+    AP-shaped results, as elex would write them, and the calendar sheet
+    that goes with them.
+
+    Every state has a Senate race, a governor's race, `house_seats` House
+    races and `ballot_measures` ballot measures. Senate and governor's
+    races have results for `counties` counties per state, plus
+    `townships` townships in New England.
+    """
+    def __init__(self, states=50, house_seats=9, counties=62, townships=100, candidates=3, ballot_measures=3, seed=0):
+        self.states = STATES[:states]
+        self.house_seats = house_seats
+        self.counties = counties
+        self.townships = townships
+        self.candidates = candidates
+        self.ballot_measures = ballot_measures
+        self.random = random.Random(seed)
+        self.lastupdated = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        self._raceid = 0
+
+    def write_results(self, filename):
+        """
+        Write the results as elex CSV, and return how many rows there are.
+        """
+        columns = [field.db_column for field in models.Result._meta.sorted_fields]
+        count = 0
+        with open(filename, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in self.results():
+                writer.writerow(row)
+                count += 1
+        return count
+
+    def results(self):
+        for state_index, (statepostal, statename) in enumerate(self.states):
+            state_fips = '{0:02d}'.format(state_index + 1)
+            state = {
+                'statepostal': statepostal,
+                'statename': statename,
+                'fips': state_fips
+            }
+
+            for officeid, officename in [('S', 'U.S. Senate'), ('G', 'Governor')]:
+                for row in self._race(state, officeid, officename, local=True):
+                    yield row
+            for seatnum in range(1, self.house_seats + 1):
+                for row in self._race(state, 'H', 'U.S. House', seatnum=seatnum):
+                    yield row
+            for measure in range(1, self.ballot_measures + 1):
+                for row in self._race(state, 'I', 'Question {0}'.format(measure), is_ballot_measure=True):
+                    yield row
+
+    def calendar(self):
+        """
+        Calendar sheets shaped like the ones `create_race_meta` reads.
+        """
+        calendar = {
+            'poll_times': [],
+            'senate_seats': [],
+            'house_seats': [],
+            'governorships': [],
+            'ballot_measures': []
+        }
+        raceid = 0
+        for statepostal, statename in self.states:
+            calendar['poll_times'].append({
+                'key': statepostal,
+                'time_est': '8:00 PM',
+                'first_results_est': '8:30 PM',
+                'time_all_est': '9:00 PM'
+            })
+            calendar['senate_seats'].append({'state': statepostal, 'special': 'False', 'party': 'Dem'})
+            calendar['governorships'].append({'state': statepostal, 'party': 'GOP'})
+            raceid += 2
+
+            for seatnum in range(1, self.house_seats + 1):
+                calendar['house_seats'].append({
+                    'seat': '{0}-{1}'.format(statepostal, seatnum),
+                    'party': 'GOP' if seatnum % 2 else 'Dem',
+                    'voting_member': 'True',
+                    'key_race': 'True' if seatnum == 1 else 'False'
+                })
+                raceid += 1
+
+            for measure in range(1, self.ballot_measures + 1):
+                raceid += 1
+                calendar['ballot_measures'].append({
+                    'state': statepostal,
+                    'raceid': str(raceid),
+                    'big_board_theme': 'Taxes' if measure == 1 else ''
+                })
+        return calendar
+
+    def _race(self, state, officeid, officename, seatnum=None, is_ballot_measure=False, local=False):
+        self._raceid += 1
+        raceid = str(self._raceid)
+
+        if is_ballot_measure:
+            candidates = [('', 'Yes', None), ('', 'No', None)]
+        else:
+            candidates = [
+                ('Candidate', '{0}-{1}'.format(raceid, number), PARTIES[number % len(PARTIES)])
+                for number in range(self.candidates)
+            ]
+
+        reporting_units = [('state', state['statepostal'], None, state['statename'])]
+        if local:
+            reporting_units += [
+                ('county', '{0}{1:03d}'.format(state['fips'], county), '{0}{1:03d}'.format(state['fips'], county), 'County {0}'.format(county))
+                for county in range(1, self.counties + 1)
+            ]
+            if state['statepostal'] in NEW_ENGLAND:
+                reporting_units += [
+                    ('township', 'T{0}{1:05d}'.format(state['fips'], township), '{0}{1:03d}'.format(state['fips'], township % self.counties + 1), 'Township {0}'.format(township))
+                    for township in range(1, self.townships + 1)
+                ]
+
+        for level, reportingunitid, fipscode, reportingunitname in reporting_units:
+            precinctstotal = self.random.randint(5, 500)
+            precinctsreporting = self.random.randint(0, precinctstotal)
+            votecounts = [self.random.randint(0, 50000) for candidate in candidates]
+            total = sum(votecounts) or 1
+
+            for ballotorder, ((first, last, party), votecount) in enumerate(zip(candidates, votecounts), 1):
+                polid = '{0}{1}'.format(raceid, ballotorder)
+                yield {
+                    'id': '{0}-polid-{1}-{2}-{3}'.format(raceid, polid, level, reportingunitid),
+                    'raceid': raceid,
+                    'racetype': 'General',
+                    'racetypeid': 'G',
+                    'ballotorder': ballotorder,
+                    'candidateid': polid,
+                    'electiondate': app_config.NEXT_ELECTION_DATE,
+                    'electtotal': 1,
+                    'electwon': 0,
+                    'fipscode': fipscode,
+                    'first': first,
+                    'incumbent': False,
+                    'initialization_data': False,
+                    'is_ballot_measure': is_ballot_measure,
+                    'last': last,
+                    'lastupdated': self.lastupdated,
+                    'level': level,
+                    'national': True,
+                    'officeid': officeid,
+                    'officename': officename,
+                    'party': party,
+                    'polid': polid,
+                    'polnum': polid,
+                    'precinctsreporting': precinctsreporting,
+                    'precinctsreportingpct': round(precinctsreporting / precinctstotal, 4),
+                    'precinctstotal': precinctstotal,
+                    'reportingunitid': reportingunitid,
+                    'reportingunitname': reportingunitname,
+                    'runoff': False,
+                    'seatname': 'District {0}'.format(seatnum) if seatnum else None,
+                    'seatnum': seatnum,
+                    'statename': state['statename'],
+                    'statepostal': state['statepostal'],
+                    'test': True,
+                    'uncontested': False,
+                    'votecount': votecount,
+                    'votepct': round(votecount / total, 6),
+                    'winner': False
+                }
+
+
+def _run(election, folder):
+    """
+    Load and render one synthetic election, and return its row count and
+    the seconds each stage took.
+    """
+    filename = os.path.join(folder, 'results.csv')
+    rows = election.write_results(filename)
+    timings = {}
+
+    start = time.time()
+    if not data.load_results_files([filename]):
+        raise RuntimeError('could not load synthetic results')
+    timings['load'] = time.time() - start
+
+    start = time.time()
+    data.create_calls()
+    timings['create_calls'] = time.time() - start
+
+    start = time.time()
+    data.create_race_meta(calendar=election.calendar())
+    timings['create_race_meta'] = time.time() - start
+
+    start = time.time()
+    render.render_results()
+    timings['render'] = time.time() - start
+
+    start = time.time()
+    for officename in ['U.S. Senate', 'U.S. House', 'Governor']:
+        app_utils.get_results(officename)
+    timings['get_results'] = time.time() - start
+
+    return rows, timings
+
+
+def _report(runs, budget):
+    lines = ['{0:>6} {1:>8} {2} {3:>8}'.format(
+        'scale', 'rows', ' '.join('{0:>16}'.format(stage) for stage in STAGES), 'cycle'
+    )]
+    for scale, rows, timings in runs:
+        # What the daemon does every cycle; calls and metadata are
+        # only created when the database is bootstrapped
+        cycle = timings['load'] + timings['render']
+        lines.append('{0:>6} {1:>8} {2} {3:>8.2f}{4}'.format(
+            scale,
+            rows,
+            ' '.join('{0:>16.2f}'.format(timings[stage]) for stage in STAGES),
+            cycle,
+            ' over budget' if cycle > budget else ''
+        ))
+    return '\n'.join(lines)
+
+
+def _plot(runs, path):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        logger.warning('matplotlib is not installed, so no plot was made')
+        return
+
+    rows = [run[1] for run in runs]
+    figure, axes = plt.subplots()
+    for stage in STAGES:
+        axes.plot(rows, [run[2][stage] for run in runs], marker='o', label=stage)
+    axes.axhline(app_config.LOAD_RESULTS_INTERVAL, color='grey', linestyle='--', label='cycle budget')
+    axes.set_xlabel('result rows')
+    axes.set_ylabel('seconds')
+    axes.legend()
+    figure.savefig(path)
+    logger.info('plot saved to {0}'.format(path))
+
+
+@task
+def scaling(scales='0.25,0.5,1,2', states='50', house_seats='9', counties='62', townships='100', candidates='3', ballot_measures='3', plot=''):
+    """
+    Time loading, rendering and querying synthetic elections of growing
+    size. Every size but `states` is multiplied by each of `scales`.
+    Replaces everything in the local database; run `fab data.bootstrap_db`
+    afterwards to restore it. Pass `plot=<path>.png` to plot the timings,
+    if matplotlib is installed.
+    """
+    utils.confirm('This replaces all results, calls and race metadata in the {0} database. Continue?'.format(
+        app_config.database['PGDATABASE']
+    ))
+
+    output_folder = app_config.DATA_OUTPUT_FOLDER
+    folder = tempfile.mkdtemp()
+    app_config.DATA_OUTPUT_FOLDER = os.path.join(folder, 'rendered')
+    os.makedirs(app_config.DATA_OUTPUT_FOLDER)
+
+    runs = []
+    try:
+        for scale in scales.split(','):
+            factor = float(scale)
+            election = SyntheticElection(
+                states=int(states),
+                house_seats=max(1, int(round(int(house_seats) * factor))),
+                counties=max(1, int(round(int(counties) * factor))),
+                townships=max(1, int(round(int(townships) * factor))),
+                candidates=max(2, int(round(int(candidates) * factor))),
+                ballot_measures=max(1, int(round(int(ballot_measures) * factor)))
+            )
+            rows, timings = _run(election, folder)
+            logger.info('scale {0}: {1} rows'.format(scale, rows))
+            runs.append((scale, rows, timings))
+    finally:
+        app_config.DATA_OUTPUT_FOLDER = output_folder
+        shutil.rmtree(folder)
+
+    print(_report(runs, app_config.LOAD_RESULTS_INTERVAL))
+
+    if plot:
+        _plot(runs, plot)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Fetch ACS tables from the Census Reporter API, many counties at a time.
+"""
+
+import app_config
+import json
+import logging
+import os
+import requests
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+
+class TokenBucket(object):
+    """
+    Allow `rate` calls per second on average, in bursts of up to
+    `capacity` calls, across threads.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class CensusFetcher(object):
+    """
+    Fetch tables for many geographies with batched, concurrent and
+    rate-limited requests.
+
+    Each geography's response is saved to `cache_path` as soon as it
+    arrives, and is never requested again, so an interrupted run picks
+    up where it left off.
+    """
+    def __init__(self, tables, base_url=None, cache_path=None, batch_size=None,
+                 workers=None, requests_per_second=None, retries=3, timeout=30):
+        self.tables = sorted(tables)
+        self.base_url = base_url or app_config.CENSUS_REPORTER_URL
+        self.cache_path = os.path.join(
+            cache_path or app_config.CENSUS_CACHE_PATH,
+            '-'.join(self.tables)
+        )
+        self.batch_size = batch_size or app_config.CENSUS_BATCH_SIZE
+        self.workers = workers or app_config.CENSUS_WORKERS
+        self.bucket = TokenBucket(requests_per_second or app_config.CENSUS_REQUESTS_PER_SECOND)
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def fetch(self, geo_ids):
+        """
+        Return a dict of each geography's response, in the same shape as
+        a response for that geography alone. Geographies that couldn't
+        be fetched are left out.
+        """
+        responses = {}
+        missing = []
+        for geo_id in sorted(set(geo_ids)):
+            cached = self._read_cache(geo_id)
+            if cached is None:
+                missing.append(geo_id)
+            else:
+                responses[geo_id] = cached
+
+        logger.info('{0} geographies cached, {1} to fetch'.format(len(responses), len(missing)))
+
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for fetched in executor.map(self._fetch_batch, batches):
+                responses.update(fetched)
+
+        failed = len(set(geo_ids)) - len(responses)
+        if failed:
+            logger.warning('{0} geographies could not be fetched; run again to retry them'.format(failed))
+
+        return responses
+
+    def _fetch_batch(self, geo_ids):
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            wait = min(2 ** attempt, 30)
+            try:
+                response = self.session.get(self.base_url, params={
+                    'geo_ids': ','.join(geo_ids),
+                    'table_ids': ','.join(self.tables)
+                }, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.warning('census request failed: {0}'.format(e))
+            else:
+                if response.status_code == 200:
+                    return self._split(response.json())
+
+                # One unknown geography fails the whole request, so
+                # split the batch until the bad one is on its own
+                if response.status_code in (400, 404):
+                    if len(geo_ids) == 1:
+                        logger.warning('census reporter has no data for {0}: {1}'.format(geo_ids[0], response.status_code))
+                        return {}
+                    middle = len(geo_ids) // 2
+                    fetched = self._fetch_batch(geo_ids[:middle])
+                    fetched.update(self._fetch_batch(geo_ids[middle:]))
+                    return fetched
+
+                # Anything else, rate limiting included, is retried
+                logger.warning('census request returned {0}'.format(response.status_code))
+                wait = self._retry_after(response, wait)
+
+            if attempt < self.retries:
+                time.sleep(wait)
+
+        logger.warning('gave up fetching {0} geographies after {1} attempts'.format(len(geo_ids), self.retries + 1))
+        return {}
+
+    def _retry_after(self, response, default):
+        try:
+            return min(float(response.headers['Retry-After']), 60)
+        except (KeyError, ValueError):
+            return default
+
+    def _split(self, payload):
+        fetched = {}
+        for geo_id, data in payload.get('data', {}).items():
+            response = {
+                'tables': payload.get('tables'),
+                'geography': {geo_id: payload.get('geography', {}).get(geo_id)},
+                'data': {geo_id: data}
+            }
+            self._write_cache(geo_id, response)
+            fetched[geo_id] = response
+        return fetched
+
+    def _cache_file(self, geo_id):
+        return os.path.join(self.cache_path, '{0}.json'.format(geo_id))
+
+    def _read_cache(self, geo_id):
+        try:
+            with open(self._cache_file(geo_id)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_cache(self, geo_id, response):
+        os.makedirs(self.cache_path, exist_ok=True)
+        path = self._cache_file(geo_id)
+        tmp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(response, f)
+        os.replace(tmp_path, path)
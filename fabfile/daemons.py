@@ -3,9 +3,21 @@ from fabric.api import execute, require, settings, task
 
 
 import app_config
+import fcntl
 import logging
+import metrics
+import notifications
+import os
+import queue
+import shutil
 import sys
 
+from contextlib import contextmanager
+from models import models
+from models.profiler import profiler
+
+from .text import SheetRefresher
+
 logging.basicConfig(format=app_config.LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(app_config.LOG_LEVEL)
@@ -31,21 +43,128 @@ def main(run_once=False):
     """
     results_start = 0
 
+    sheets = SheetRefresher(app_config.SHEETS_REFRESH_INTERVAL, app_config.SHEETS_REFRESH_TIMEOUT)
+    if run_once:
+        sheets.refresh()
+    else:
+        # Results are rendered with whatever copy of the sheets is on hand
+        sheets.start()
+
     while True:
         now = time()
 
         if app_config.LOAD_RESULTS_INTERVAL and (now - results_start) > app_config.LOAD_RESULTS_INTERVAL:
             results_start = now
-            logger.info('updating get-caught-up text (runs in parallel)')
-            execute('text.update_in_parallel')
             logger.info('loading results')
-            execute('data.load_results')
+            with metrics.timer('stage', stage='load_results'):
+                execute('data.load_results')
             logger.info("results loaded: %s seconds" % (time() - results_start))
-            execute('publish_results')
+            with metrics.timer('stage', stage='publish_results'), publishing():
+                execute('publish_results')
             logger.info("results rendered and published: %s seconds" % (time() - results_start))
 
+            for name, value in models.db.pool_stats().items():
+                metrics.set_gauge('db_pool_' + name, value)
+            metrics.end_cycle(cycle_seconds=round(time() - results_start, 4))
+
+            if profiler.enabled:
+                profiler.save_report(models.db)
+
         if run_once:
             logger.info('run once specified, exiting')
             sys.exit(0)
 
         sleep(0.1)
+
+
+@contextmanager
+def publishing():
+    """
+    Take turns with the other daemon to render and upload, so whichever
+    renders last also uploads last
+    """
+    directory = os.path.dirname(app_config.PUBLISH_LOCK_PATH)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(app_config.PUBLISH_LOCK_PATH, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@task
+def render_and_publish_calls():
+    """
+    Render and deploy the files that change when calls are made in the admin
+    """
+    require('settings', provided_by=['production', 'staging'])
+    try:
+        with settings(warn_only=True):
+            calls_main()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+@task
+def calls_main():
+    """
+    Wait for calls from the admin app, and publish each burst of them
+    """
+    # This process only ever publishes the files for calls, so it must
+    # never share an output folder with `render_all`
+    app_config.DATA_OUTPUT_FOLDER = app_config.CALLS_DATA_OUTPUT_FOLDER
+
+    subscriber = notifications.listener.subscribe()
+    while True:
+        # The next results cycle publishes these calls anyway, so a
+        # failure here shouldn't stop this daemon
+        try:
+            publish_calls_burst(subscriber)
+        except Exception:
+            logger.exception('failed to publish calls')
+            sleep(1)
+
+
+def publish_calls_burst(subscriber):
+    """
+    Wait for an event, collect any others that arrive in the next
+    `CALLS_RENDER_DELAY` seconds, and publish the calls among them
+    """
+    events = [subscriber.get()]
+
+    deadline = time() + app_config.CALLS_RENDER_DELAY
+    while time() < deadline:
+        try:
+            events.append(subscriber.get(timeout=max(0, deadline - time())))
+        except queue.Empty:
+            break
+
+    calls = [event for event in events if event.get('type') == 'calls']
+    if calls:
+        publish_calls(calls)
+
+
+def publish_calls(calls):
+    start = time()
+
+    officenames = set(call['officename'] for call in calls)
+    # Chamber calls aren't for any one state
+    statepostals = set(call['statepostal'] for call in calls if call.get('statepostal'))
+
+    if os.path.isdir(app_config.DATA_OUTPUT_FOLDER):
+        shutil.rmtree(app_config.DATA_OUTPUT_FOLDER)
+    os.makedirs(app_config.DATA_OUTPUT_FOLDER)
+
+    with publishing():
+        execute('render.render_calls', officenames, statepostals)
+        execute('publish_rendered_data')
+
+    logger.info('{0} calls ({1}; {2}) published: {3:.3f} seconds'.format(
+        len(calls),
+        ', '.join(sorted(officenames)),
+        ', '.join(sorted(statepostals)) or 'no states',
+        time() - start
+    ))
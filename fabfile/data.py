@@ -8,25 +8,39 @@ import csv
 import json
 import logging
 import math
+import metrics
+import notifications
 import os
+import psycopg2
 import re
-from time import sleep
+import shlex
+import signal
+import subprocess
+import time
 
-import copytext
+from concurrent.futures import ThreadPoolExecutor
 from fabric.api import execute, hide, local, task, settings, shell_env
 from fabric.state import env
+from .census import CensusFetcher
+from operator import itemgetter
 from models import models
-import requests
+from peewee import DatabaseError, OperationalError
+from render_utils import load_copy
 import yaml
 
 logging.basicConfig(format=app_config.LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(app_config.LOG_LEVEL)
 
-CENSUS_REPORTER_URL = 'https://api.censusreporter.org/1.0/data/show/acs2016_5yr'
+# Results are loaded into this table, then swapped in for `result`
+SHADOW_RESULTS_TABLE = 'result_new'
+
 FIPS_TEMPLATE = '05000US{0}'
 CENSUS_TABLES = ['B01003', 'B02001', 'B03002', 'B19013', 'B15001']
 
+# CSV lookups for `save_old_data`, by filename; see `_load_index`
+_csv_indexes = {}
+
 
 @task
 def bootstrap_db():
@@ -46,6 +60,7 @@ def create_db():
         if env.get('settings'):
             execute('servers.stop_service', 'uwsgi')
             execute('servers.stop_service', 'fetch_and_publish_results')
+            execute('servers.stop_service', 'render_and_publish_calls')
 
         with shell_env(**app_config.database):
             local('dropdb --host={PGHOST} --port={PGPORT} --username={PGUSER} --if-exists {PGDATABASE}'.format(**app_config.database))
@@ -54,6 +69,7 @@ def create_db():
         if env.get('settings'):
             execute('servers.start_service', 'uwsgi')
             execute('servers.start_service', 'fetch_and_publish_results')
+            execute('servers.start_service', 'render_and_publish_calls')
 
 
 @task
@@ -97,14 +113,25 @@ def get_valid_filename(s):
 
 
 @task
-def load_results(initialize=False):
+def load_results(initialize=False, flag_sets=None):
     """
     Load AP results. Defaults to next election, or specify a date as a parameter.
+    Pass `flag_sets` to fetch with those elex flag sets instead of the
+    configured ones; from the command line, separate them with
+    semicolons and escape commas, eg
+    `fab "data.load_results:flag_sets=--officeids S\\,G;--officeids H"`.
+    Returns whether the results were loaded.
     """
-    if initialize is True:
-        flag_sets = app_config.ELEX_INIT_FLAG_SETS
-    else:
-        flag_sets = app_config.ELEX_FLAG_SETS
+    if flag_sets is None:
+        if initialize is True:
+            flag_sets = app_config.ELEX_INIT_FLAG_SETS
+        else:
+            flag_sets = app_config.ELEX_FLAG_SETS
+    elif isinstance(flag_sets, str):
+        flag_sets = [flag_set.strip() for flag_set in flag_sets.split(';') if flag_set.strip()]
+
+    if not flag_sets:
+        raise ValueError('no elex flag sets to load results with')
 
     if not os.path.isdir(app_config.ELEX_OUTPUT_FOLDER):
         os.makedirs(app_config.ELEX_OUTPUT_FOLDER)
@@ -113,63 +140,304 @@ def load_results(initialize=False):
 
     # Need separate filenames for the different possible elex flag sets,
     # so the simplest way is to use a hash of those flag-strings
-    cmds = [
-        'elex results {0} {1} > {2}'.format(
-            flag_set,
-            app_config.NEXT_ELECTION_DATE,
-            os.path.join(
-                app_config.ELEX_OUTPUT_FOLDER,
-                RESULTS_FILENAME_PREFIX + get_valid_filename(flag_set) + '.csv'
-            )
+    results_filenames = [
+        os.path.join(
+            app_config.ELEX_OUTPUT_FOLDER,
+            RESULTS_FILENAME_PREFIX + get_valid_filename(flag_set) + '.csv'
         )
         for flag_set in flag_sets
     ]
 
-    with shell_env(**app_config.database):
-        for cmd in cmds:
-            # The `warn_only` option turns errors into warning messages
-            # This allows us to handle errors on our own terms,
-            # like the `64` code below
-            with settings(warn_only=True), hide('output', 'running'):
-                cmd_output = local(cmd, capture=True)
-
-            # `elex` exit code `64` indicates that no new data was found,
-            # and that the previous set of results will be re-used instead
-            if not cmd_output.succeeded and cmd_output.return_code != 64:
-                logger.critical("ERROR GETTING RESULTS")
-                logger.critical(cmd_output.stderr)
-                break
-        else:
-            delete_results()
-
-            results_filenames = [
-                os.path.join(
-                    app_config.ELEX_OUTPUT_FOLDER,
-                    RESULTS_FILENAME_PREFIX + get_valid_filename(flag_set) + '.csv'
-                )
-                for flag_set in flag_sets
-            ]
-            with hide('output', 'running'):
-                local('csvstack {0} | psql {1} -c "COPY result FROM stdin DELIMITER \',\' CSV HEADER;"'.format(
-                    ' '.join(results_filenames),
-                    app_config.database['PGURI']
-                ))
-
-            # Implement candidate party overrides, in a way that's
-            # transparent to all downstream parts of the data processing
-            with hide('output', 'running'):
-                for party, polids in app_config.PARTY_OVERRIDES.items():
-                    local('''psql {} -c "
-                        UPDATE result
-                        SET party = '{}'
-                        WHERE polID = ANY('{{ {} }}'::text[]);
-                    "'''.format(
-                        app_config.database['PGURI'],
-                        party,
-                        ','.join(polids)
+    with metrics.timer('stage', stage='elex_fetch'):
+        errors = fetch_results(flag_sets, results_filenames)
+
+    # Every flag set is needed, since the load replaces all results
+    if errors:
+        logger.critical("ERROR GETTING RESULTS")
+        for flag_set, error in errors:
+            logger.critical('{0}: {1}'.format(flag_set, error))
+        return False
+
+    return load_results_files(results_filenames)
+
+
+def load_results_files(filenames):
+    """
+    Load elex CSVs in place of the current results. Returns whether they
+    were loaded.
+    """
+    # Load into an empty copy of the results table, which is swapped
+    # in once it's complete, so readers never see a partial load
+    try:
+        with metrics.timer('stage', stage='copy'):
+            row_counts = copy_results(filenames)
+    except (ValueError, IOError, DatabaseError, psycopg2.Error) as e:
+        logger.critical('ERROR LOADING RESULTS')
+        logger.critical(e)
+        return False
+
+    for filename, count in row_counts:
+        logger.info('{0} results copied from {1}'.format(count, filename))
+    metrics.set_gauge('results_rows', sum(count for filename, count in row_counts))
+
+    with metrics.timer('stage', stage='swap_results'):
+        swapped = swap_results_table()
+
+    if not swapped:
+        logger.critical('ERROR SWAPPING IN NEW RESULTS')
+        return False
+
+    logger.info('results loaded')
+    notifications.publish('results')
+    return True
+
+
+def fetch_results(flag_sets, filenames):
+    """
+    Run `elex results` for each flag set at the same time, writing each
+    one's CSV to the matching filename. Each fetch is retried, up to
+    `ELEX_FETCH_ATTEMPTS` times, until `ELEX_FETCH_TIMEOUT` seconds after
+    the first started.
+
+    Returns a list of `(flag_set, error)` for any that failed.
+    """
+    if not flag_sets:
+        raise ValueError('no elex flag sets to fetch')
+
+    deadline = time.time() + app_config.ELEX_FETCH_TIMEOUT
+
+    with ThreadPoolExecutor(max_workers=len(flag_sets)) as executor:
+        errors = list(executor.map(
+            lambda args: _fetch_flag_set(*args),
+            [(flag_set, filename, deadline) for flag_set, filename in zip(flag_sets, filenames)]
+        ))
+
+    return [(flag_set, error) for flag_set, error in zip(flag_sets, errors) if error]
+
+
+def _fetch_flag_set(flag_set, filename, deadline):
+    cmd = ['elex', 'results'] + shlex.split(flag_set) + [app_config.NEXT_ELECTION_DATE]
+    # Written to a temporary file first, so a failed fetch never
+    # replaces the last good one
+    tmp_filename = '{0}.tmp'.format(filename)
+    error = None
+
+    for attempt in range(1, app_config.ELEX_FETCH_ATTEMPTS + 1):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        with open(tmp_filename, 'w') as f:
+            process = subprocess.Popen(
+                cmd,
+                stdout=f,
+                stderr=subprocess.PIPE,
+                env=dict(os.environ, **app_config.database),
+                universal_newlines=True,
+                # So that any of its children are stopped with it
+                start_new_session=True
+            )
+            try:
+                stderr = process.communicate(timeout=remaining)[1]
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.communicate()
+                error = 'timed out'
+                continue
+
+        # `elex` exit code `64` indicates that no new data was found,
+        # and that the previous set of results will be re-used instead
+        if process.returncode in (0, 64):
+            os.replace(tmp_filename, filename)
+            return None
+
+        error = stderr.strip() or 'exit code {0}'.format(process.returncode)
+        logger.warning('elex fetch attempt {0} for {1} failed: {2}'.format(attempt, flag_set, error))
+        time.sleep(max(0, min(attempt, deadline - time.time())))
+
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    return error or 'timed out'
+
+
+def copy_results(filenames):
+    """
+    Copy elex CSVs into a new, empty shadow results table, and apply
+    party overrides to it, all in one transaction on a pooled connection.
+    Returns the number of rows copied from each file.
+
+    Raises `ValueError` if a file's columns don't match the results
+    table's, or if it has no results, since that means elex failed.
+    """
+    columns = [field.db_column for field in models.Result._meta.sorted_fields]
+    row_counts = []
+    copied = 0
+
+    with models.db.atomic():
+        _create_shadow_results_table()
+
+        cursor = models.db.get_cursor()
+        for filename in filenames:
+            with open(filename) as f:
+                header = next(csv.reader([f.readline()]), [])
+                if sorted(header) != sorted(columns):
+                    raise ValueError('{0} has unexpected columns; missing {1}, extra {2}'.format(
+                        filename,
+                        sorted(set(columns) - set(header)),
+                        sorted(set(header) - set(columns))
                     ))
 
-            logger.info('results loaded')
+                # The header is consumed, so copy the rest as plain CSV
+                cursor.copy_expert('COPY {0} ({1}) FROM STDIN WITH CSV;'.format(
+                    SHADOW_RESULTS_TABLE,
+                    ', '.join(header)
+                ), f)
+
+            # psycopg2 doesn't reliably set the cursor's rowcount for
+            # COPY, so count what the table gained
+            total = models.db.execute_sql('SELECT count(*) FROM {0};'.format(SHADOW_RESULTS_TABLE)).fetchone()[0]
+            if total <= copied:
+                raise ValueError('{0} has no results'.format(filename))
+            row_counts.append((filename, total - copied))
+            copied = total
+
+        # Implement candidate party overrides, in a way that's
+        # transparent to all downstream parts of the data processing.
+        # They're applied in the same transaction as the copy, so the
+        # un-overridden parties are never visible
+        party_overrides = _party_overrides_sql(SHADOW_RESULTS_TABLE)
+        if party_overrides:
+            with metrics.timer('stage', stage='party_overrides'):
+                models.db.execute_sql(party_overrides)
+
+    return row_counts
+
+
+def _party_overrides_sql(table='result'):
+    """
+    A single UPDATE that applies every party in `PARTY_OVERRIDES`.
+    """
+    values = [
+        "('{0}', '{1}')".format(polid.replace("'", "''"), party.replace("'", "''"))
+        for party, polids in sorted(app_config.PARTY_OVERRIDES.items())
+        for polid in polids
+    ]
+    if not values:
+        return None
+
+    return (
+        'UPDATE {0} SET party = overrides.party '
+        'FROM (VALUES {1}) AS overrides (polid, party) '
+        'WHERE {0}.polid = overrides.polid;'
+    ).format(table, ', '.join(values))
+
+
+def swap_results_table():
+    """
+    Replace the results table with the freshly loaded shadow table, in
+    one short transaction. Calls and race metadata keep pointing at the
+    results with the same IDs.
+
+    The swap needs the results table to itself, so it gives up after
+    `RESULTS_SWAP_LOCK_TIMEOUT` seconds of waiting for readers, rather
+    than stall every query queued behind it, and tries again. Returns
+    whether it succeeded.
+    """
+    # The shadow table is new every cycle, so without this the first
+    # queries after the swap would be planned with no statistics
+    with metrics.timer('stage', stage='analyze'):
+        models.db.execute_sql('ANALYZE {0};'.format(SHADOW_RESULTS_TABLE))
+
+    for attempt in range(1, app_config.RESULTS_SWAP_ATTEMPTS + 1):
+        try:
+            with models.db.atomic():
+                _swap_results_table()
+            return True
+        # Lock timeouts aren't translated by peewee
+        except (OperationalError, psycopg2.OperationalError) as e:
+            logger.warning('results swap attempt {0} failed: {1}'.format(attempt, str(e).strip()))
+
+    return False
+
+
+def _swap_results_table():
+    models.db.execute_sql("SET LOCAL lock_timeout = '{0}s';".format(app_config.RESULTS_SWAP_LOCK_TIMEOUT))
+
+    # Foreign keys follow the table they reference through renames, so
+    # drop them and recreate them against the new table. They're not
+    # revalidated, since calls may outlive a candidate in the AP's data
+    foreign_keys = models.db.execute_sql('''
+        SELECT conrelid::regclass::text, conname
+        FROM pg_constraint
+        WHERE confrelid = 'result'::regclass AND contype = 'f';
+    ''').fetchall()
+
+    # A partitioned shadow table's partitions are renamed along with it
+    tables = [SHADOW_RESULTS_TABLE] + [
+        table for (table,) in models.db.execute_sql(
+            'SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass;',
+            (SHADOW_RESULTS_TABLE,)
+        )
+    ]
+    indexes = models.db.execute_sql(
+        'SELECT indexname FROM pg_indexes WHERE tablename = ANY(%s);',
+        (tables,)
+    ).fetchall()
+
+    for table, name in foreign_keys:
+        models.db.execute_sql('ALTER TABLE {0} DROP CONSTRAINT {1};'.format(table, name))
+
+    # Also drops the live table's partitions, if it has any
+    models.db.execute_sql('DROP TABLE result;')
+
+    # Give tables and indexes their usual names, so the next shadow
+    # table's are free
+    for table in tables:
+        models.db.execute_sql('ALTER TABLE {0} RENAME TO {1};'.format(table, _live_results_name(table)))
+    for (index,) in indexes:
+        models.db.execute_sql('ALTER INDEX {0} RENAME TO {1};'.format(index, _live_results_name(index)))
+
+    # Postgres can't reference a partitioned table's IDs on their own
+    if not app_config.RESULT_PARTITIONS:
+        for field in models.Result._meta.reverse_rel.values():
+            models.db.execute_sql('ALTER TABLE {0} ADD CONSTRAINT {0}_{1}_fkey FOREIGN KEY ({1}) REFERENCES result ({2}) NOT VALID;'.format(
+                field.model_class._meta.db_table,
+                field.db_column,
+                field.to_field.db_column
+            ))
+
+
+def _live_results_name(name):
+    return 'result' + name[len(SHADOW_RESULTS_TABLE):]
+
+
+def _create_shadow_results_table():
+    models.db.execute_sql('DROP TABLE IF EXISTS {0};'.format(SHADOW_RESULTS_TABLE))
+
+    if app_config.RESULT_PARTITIONS:
+        models.db.execute_sql('CREATE TABLE {0} (LIKE result INCLUDING DEFAULTS) PARTITION BY LIST (level);'.format(SHADOW_RESULTS_TABLE))
+        for name, levels in sorted(app_config.RESULT_PARTITIONS.items()):
+            models.db.execute_sql('CREATE TABLE {0}_{1} PARTITION OF {0} FOR VALUES IN ({2});'.format(
+                SHADOW_RESULTS_TABLE,
+                name,
+                ', '.join(['%s'] * len(levels))
+            ), levels)
+        models.db.execute_sql('CREATE TABLE {0}_other PARTITION OF {0} DEFAULT;'.format(SHADOW_RESULTS_TABLE))
+
+        # Unique keys of a partitioned table have to include the
+        # partition key; IDs are unique on their own anyway
+        models.db.execute_sql('CREATE UNIQUE INDEX {0}_id_level ON {0} (id, level);'.format(SHADOW_RESULTS_TABLE))
+    elif _is_partitioned('result'):
+        models.db.execute_sql('CREATE TABLE {0} (LIKE result INCLUDING DEFAULTS, PRIMARY KEY (id));'.format(SHADOW_RESULTS_TABLE))
+    else:
+        models.db.execute_sql('CREATE TABLE {0} (LIKE result INCLUDING ALL);'.format(SHADOW_RESULTS_TABLE))
+
+
+def _is_partitioned(table):
+    return models.db.execute_sql(
+        'SELECT count(*) FROM pg_partitioned_table WHERE partrelid = %s::regclass;',
+        (table,)
+    ).fetchone()[0] > 0
 
 
 @task
@@ -201,10 +469,15 @@ def create_calls():
 
 
 @task
-def create_race_meta():
+def create_race_meta(calendar=None):
+    """
+    Create race metadata for results, from the calendar sheet, or from
+    `calendar` if it's given.
+    """
     models.RaceMeta.delete().execute()
 
-    calendar = copytext.Copy(app_config.CALENDAR_PATH)
+    if calendar is None:
+        calendar = load_copy(app_config.CALENDAR_PATH)
     calendar_sheet = calendar['poll_times']
     senate_sheet = calendar['senate_seats']
     house_sheet = calendar['house_seats']
@@ -350,165 +623,127 @@ def write_unemployment_csv(start_state='AA'):
 
 @task
 def get_census_data(start_state='AA'):
+    """
+    Download census tables for every county in states after `start_state`,
+    to `data/census/<state>.json`. Counties already downloaded are cached,
+    so run this again to retry any that failed.
+    """
 
     # SD 46102 manually entered from 2012-2016 American Community Survey 5-Year Estimates
-    
+
     state_results = models.Result.select(models.Result.statepostal).distinct().order_by(models.Result.statepostal)
 
+    geo_ids = {}
     for state_result in state_results:
         state = state_result.statepostal
 
         sorts = sorted([start_state, state])
 
         if sorts[0] == state:
-            logging.info('skipping', state)
+            logger.info('skipping {0}'.format(state))
             continue
 
-        logging.info('getting', state)
-        output = {}
         fips_results = models.Result.select(models.Result.fipscode).distinct().where(models.Result.statepostal == state).order_by(models.Result.fipscode)
-        count = 0
-        total = len(fips_results)
+        state_geo_ids = geo_ids[state] = {}
         for result in fips_results:
             if result.fipscode:
-                count += 1
                 if result.fipscode == '02000':
                     geo_id = '04000US02'
                 elif result.fipscode == '46102':
                     geo_id = FIPS_TEMPLATE.format('46113')
                 else:
                     geo_id = FIPS_TEMPLATE.format(result.fipscode)
-                params = {
-                    'geo_ids': geo_id,
-                    'table_ids': ','.join(CENSUS_TABLES)
-                }
-                response = requests.get(CENSUS_REPORTER_URL, params=params)
-                if response.status_code == 200:
-                    print('fipscode succeeded', result.fipscode, count, 'counties done, out of', total, 'in', state)
-                    output[result.fipscode] = response.json()
-                    sleep(1)
-                else:
-                    print('fipscode failed:', result.fipscode, response.status_code)
-                    sleep(10)
-                    continue
+                state_geo_ids[result.fipscode] = geo_id
+
+    fetcher = CensusFetcher(CENSUS_TABLES)
+    responses = fetcher.fetch([geo_id for state_geo_ids in geo_ids.values() for geo_id in state_geo_ids.values()])
+
+    os.makedirs('data/census', exist_ok=True)
+    for state, state_geo_ids in sorted(geo_ids.items()):
+        output = {
+            fipscode: responses[geo_id]
+            for fipscode, geo_id in state_geo_ids.items()
+            if geo_id in responses
+        }
+        logger.info('{0} of {1} counties fetched in {2}'.format(len(output), len(state_geo_ids), state))
 
         with open('data/census/{0}.json'.format(state), 'w') as f:
             json.dump(output, f)
 
 
-@task
-def extract_census_data(fipscode, census_json):
-    fips_census = census_json.get(fipscode)
-    if fips_census:
-        data = fips_census.get('data')
-        for county, tables in data.items():
-            population = tables['B01003']['estimate']
-            race = tables['B02001']['estimate']
-            hispanic = tables['B03002']['estimate']
-            education = tables['B15001']['estimate']
-            education_error = tables['B15001']['error']
-            income = tables['B19013']['estimate']
-
-            total_population = population['B01003001']
-
-            race_total = race['B02001001']
-            percent_black = race['B02001003'] / race_total
-
-            hispanic_total = hispanic['B03002001']
-            percent_white = hispanic['B03002003'] / hispanic_total
-            percent_hispanic = hispanic['B03002012'] / hispanic_total
-
-            median_income = income['B19013001']
-
-            percent_bachelors, error = calculate_percent_bachelors(education, education_error)
-
-            print(fipscode, percent_bachelors, error)
-            return {
-                'population': total_population,
-                'percent_white': percent_white,
-                'percent_black': percent_black,
-                'percent_hispanic': percent_hispanic,
-                'median_income': median_income,
-                'percent_bachelors': percent_bachelors,
-                'error': error
-            }
-    else:
-        return None
+# Bachelor's and graduate degree holders in each age group, by sex
+BACHELORS_COLUMNS = [
+    'B15001009', 'B15001010', 'B15001017', 'B15001018', 'B15001025',
+    'B15001026', 'B15001033', 'B15001034', 'B15001041', 'B15001042',
+    'B15001050', 'B15001051', 'B15001058', 'B15001059', 'B15001066',
+    'B15001067', 'B15001074', 'B15001075', 'B15001082', 'B15001083'
+]
+# The error has always counted B15001049 too, though its estimate
+# isn't one of the degree holders; keep it, so errors don't change
+BACHELORS_ERROR_COLUMNS = BACHELORS_COLUMNS + ['B15001049']
 
 
-def calculate_percent_bachelors(education, education_error):
-    ed_total_population = education['B15001001']
-
-    male_18_bachelors = education['B15001009']
-    male_18_grad = education['B15001010']
-    male_18 = male_18_bachelors + male_18_grad
-
-    male_25_bachelors = education['B15001017']
-    male_25_grad = education['B15001018']
-    male_25 = male_25_bachelors + male_25_grad
-
-    male_35_bachelors = education['B15001025']
-    male_35_grad = education['B15001026']
-    male_35 = male_35_bachelors + male_35_grad
-
-    male_45_bachelors = education['B15001033']
-    male_45_grad = education['B15001034']
-    male_45 = male_45_bachelors + male_45_grad
-
-    male_65_bachelors = education['B15001041']
-    male_65_grad = education['B15001042']
-    male_65 = male_65_bachelors + male_65_grad
-
-    male_total = male_18 + male_25 + male_35 + male_45 + male_65
-
-    female_18_bachelors = education['B15001050']
-    female_18_grad = education['B15001051']
-    female_18 = female_18_bachelors + female_18_grad
-
-    female_25_bachelors = education['B15001058']
-    female_25_grad = education['B15001059']
-    female_25 = female_25_bachelors + female_25_grad
-
-    female_35_bachelors = education['B15001066']
-    female_35_grad = education['B15001067']
-    female_35 = female_35_bachelors + female_35_grad
-
-    female_45_bachelors = education['B15001074']
-    female_45_grad = education['B15001075']
-    female_45 = female_45_bachelors + female_45_grad
-
-    female_65_bachelors = education['B15001082']
-    female_65_grad = education['B15001083']
-    female_65 = female_65_bachelors + female_65_grad
-
-    female_total = female_18 + female_25 + female_35 + female_45 + female_65
-
-    percent_bachelors = (male_total + female_total) / ed_total_population
-    error = (math.sqrt(
-        math.pow(education_error['B15001009'], 2) +
-        math.pow(education_error['B15001010'], 2) +
-        math.pow(education_error['B15001017'], 2) +
-        math.pow(education_error['B15001018'], 2) +
-        math.pow(education_error['B15001025'], 2) +
-        math.pow(education_error['B15001026'], 2) +
-        math.pow(education_error['B15001033'], 2) +
-        math.pow(education_error['B15001034'], 2) +
-        math.pow(education_error['B15001041'], 2) +
-        math.pow(education_error['B15001042'], 2) +
-        math.pow(education_error['B15001049'], 2) +
-        math.pow(education_error['B15001050'], 2) +
-        math.pow(education_error['B15001051'], 2) +
-        math.pow(education_error['B15001058'], 2) +
-        math.pow(education_error['B15001059'], 2) +
-        math.pow(education_error['B15001066'], 2) +
-        math.pow(education_error['B15001067'], 2) +
-        math.pow(education_error['B15001074'], 2) +
-        math.pow(education_error['B15001075'], 2) +
-        math.pow(education_error['B15001082'], 2) +
-        math.pow(education_error['B15001083'], 2)
-    ) / ed_total_population)
-
-    return percent_bachelors, error
+def extract_census_batch(census_json):
+    """
+    Extract population, race, income and education figures for every
+    county in a state's census JSON at once. Returns a dict of FIPS code
+    to census data. Shares that can't be calculated, eg from a zero
+    total, are `None`.
+    """
+    # Only needed here, so other tasks and the daemon don't need numpy
+    import numpy as np
+
+    fipscodes = []
+    tables = []
+    for fipscode, fips_census in census_json.items():
+        data = fips_census.get('data') if fips_census else None
+        if data:
+            fipscodes.append(fipscode)
+            tables.append(next(iter(data.values())))
+
+    if not fipscodes:
+        return {}
+
+    def columns(table, names, part='estimate'):
+        getter = itemgetter(*names)
+        return np.array([getter(county[table][part]) for county in tables], dtype=float)
+
+    race = columns('B02001', ['B02001001', 'B02001003'])
+    hispanic = columns('B03002', ['B03002001', 'B03002003', 'B03002012'])
+    education = columns('B15001', ['B15001001'] + BACHELORS_COLUMNS)
+    education_error = columns('B15001', BACHELORS_ERROR_COLUMNS, 'error')
+    ed_total_population = education[:, 0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_black = race[:, 1] / race[:, 0]
+        percent_white = hispanic[:, 1] / hispanic[:, 0]
+        percent_hispanic = hispanic[:, 2] / hispanic[:, 0]
+        percent_bachelors = education[:, 1:].sum(axis=1) / ed_total_population
+        error = np.sqrt(np.square(education_error).sum(axis=1)) / ed_total_population
+
+    def finite(values):
+        return [value if math.isfinite(value) else None for value in values.tolist()]
+
+    shares = zip(
+        finite(percent_white),
+        finite(percent_black),
+        finite(percent_hispanic),
+        finite(percent_bachelors),
+        finite(error)
+    )
+
+    return {
+        fipscode: {
+            'population': county['B01003']['estimate']['B01003001'],
+            'percent_white': white,
+            'percent_black': black,
+            'percent_hispanic': hispanic,
+            'median_income': county['B19013']['estimate']['B19013001'],
+            'percent_bachelors': bachelors,
+            'error': error
+        }
+        for fipscode, county, (white, black, hispanic, bachelors, error) in zip(fipscodes, tables, shares)
+    }
 
 
 def extract_margin_data(fipscode, filename):
@@ -524,27 +759,22 @@ def extract_margin_data(fipscode, filename):
     # Candidate one must be the democratic nominee
     candidate_one = 'Clinton'
     candidate_two = 'Trump'
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        candidate_one_row = [row for row in reader if row['fipscode'] == fipscode and row['last'] == candidate_one and row['level'] != 'township']
-        f.seek(0)
-        candidate_two_row = [row for row in reader if row['fipscode'] == fipscode and row['last'] == candidate_two and row['level'] != 'township']
-
-        if candidate_one_row and candidate_two_row:
-            one_result = candidate_one_row[0]['votepct']
-            two_result = candidate_two_row[0]['votepct']
+    votepcts = _load_margin_index(filename)
+    one_result = votepcts.get((fipscode, candidate_one))
+    two_result = votepcts.get((fipscode, candidate_two))
 
-            difference = (float(one_result) * 100) - (float(two_result) * 100)
+    if one_result is not None and two_result is not None:
+        difference = (float(one_result) * 100) - (float(two_result) * 100)
 
-            if difference > 0:
-                margin = 'D +{0}'.format(round(difference))
-            else:
-                margin = 'R +{0}'.format(round(abs(difference)))
+        if difference > 0:
+            margin = 'D +{0}'.format(round(difference))
+        else:
+            margin = 'R +{0}'.format(round(abs(difference)))
 
-            return margin
+        return margin
 
-        else:
-            return None
+    else:
+        return None
 
 
 def extract_unemployment_data(fipscode, filename):
@@ -555,16 +785,44 @@ def extract_unemployment_data(fipscode, filename):
     Take the latest txt file (this is the one we used in 2018: https://www.bls.gov/lau/laucnty17.txt)
     and turn it into a CSV that looks like data/unemployment.csv in this repo.
     """
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        state_fips = fipscode[:2]
-        county_fips = fipscode[-3:]
-        unemployment_row = [row for row in reader if row['State FIPS Code'] == state_fips and row['County FIPS Code'] == county_fips]
-        if unemployment_row:
-            unemployment_rate = unemployment_row[0]['Unemployment Rate (%)']
-            return float(unemployment_rate.strip())
-        else:
-            return None
+    unemployment_rate = _load_unemployment_index(filename).get((fipscode[:2], fipscode[-3:]))
+    if unemployment_rate is not None:
+        return float(unemployment_rate.strip())
+    else:
+        return None
+
+
+def _load_index(filename, key, value, include=None):
+    """
+    Read a CSV once into a dict of `key(row)` to `value(row)`, keeping
+    the first of any duplicate keys. Later calls with the same file reuse
+    the index, so each county's lookup doesn't rescan the file.
+    """
+    if filename not in _csv_indexes:
+        index = {}
+        with open(filename) as f:
+            for row in csv.DictReader(f):
+                if include is None or include(row):
+                    index.setdefault(key(row), value(row))
+        _csv_indexes[filename] = index
+    return _csv_indexes[filename]
+
+
+def _load_margin_index(filename):
+    return _load_index(
+        filename,
+        key=lambda row: (row['fipscode'], row['last']),
+        value=lambda row: row['votepct'],
+        include=lambda row: row['level'] != 'township'
+    )
+
+
+def _load_unemployment_index(filename):
+    return _load_index(
+        filename,
+        key=lambda row: (row['State FIPS Code'], row['County FIPS Code']),
+        value=lambda row: row['Unemployment Rate (%)']
+    )
 
 
 @task
@@ -581,6 +839,7 @@ def save_old_data():
 
         with open('data/census/{0}.json'.format(state)) as c:
             census_json = json.load(c)
+        census_data = extract_census_batch(census_json)
 
         fips_results = models.Result.select(models.Result.fipscode).distinct().where(models.Result.statepostal == state, models.Result.fipscode is not None).order_by(models.Result.fipscode)
 
@@ -592,7 +851,7 @@ def save_old_data():
 
             unemployment = extract_unemployment_data(result.fipscode, 'data/unemployment.csv')
             past_margin = extract_margin_data(result.fipscode, 'data/2016-presidential.csv')
-            census = extract_census_data(result.fipscode, census_json)
+            census = census_data.get(result.fipscode)
 
             this_row = {
                 'unemployment': unemployment,
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+Load tests for the admin app, against a running server and the local
+Postgres database.
+"""
+
+import app_config
+import logging
+import random
+import requests
+import threading
+import time
+
+from app_utils import SLUG_TO_OFFICENAME
+from fabric.api import task
+from models import models
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+# The endpoints an editor makes calls with
+CALL_ENDPOINTS = ['accept-ap', 'call-npr', 'call-chamber']
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(percent / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Timings(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = {}
+        self.errors = {}
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.seconds.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        lines = ['{0:<13} {1:>8} {2:>7} {3:>8} {4:>8} {5:>8} {6:>8}'.format(
+            'request', 'count', 'errors', 'per sec', 'p50 ms', 'p95 ms', 'max ms'
+        )]
+        for name, seconds in sorted(self.seconds.items()):
+            seconds = sorted(seconds)
+            lines.append('{0:<13} {1:>8} {2:>7} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f}'.format(
+                name,
+                len(seconds),
+                self.errors.get(name, 0),
+                len(seconds) / elapsed,
+                _percentile(seconds, 50) * 1000,
+                _percentile(seconds, 95) * 1000,
+                seconds[-1] * 1000
+            ))
+        return '\n'.join(lines)
+
+
+def _timed_request(timings, name, method, url, **kwargs):
+    start = time.time()
+    try:
+        response = method(url, timeout=30, **kwargs)
+        ok = response.status_code == 200
+    except requests.RequestException:
+        response = None
+        ok = False
+    timings.record(name, time.time() - start, ok)
+    return response if ok else None
+
+
+def _editor(page_url, races, end, poll_interval, call_interval, timings):
+    session = requests.Session()
+    version = None
+    next_call = time.time() + random.uniform(0, call_interval)
+
+    response = _timed_request(timings, 'page', session.get, page_url)
+    if response is None:
+        return
+
+    while time.time() < end:
+        response = _timed_request(timings, 'changes', session.get, page_url + 'changes', params={'since': version})
+        if response is not None:
+            version = response.json()['version']
+
+        if races and time.time() >= next_call:
+            _make_call(session, page_url, random.choice(races), timings)
+            next_call = time.time() + call_interval
+
+        time.sleep(poll_interval)
+
+
+def _make_call(session, page_url, race, timings):
+    """
+    Make a call on a race, or on the whole chamber, and undo it
+    """
+    endpoint = random.choice(CALL_ENDPOINTS)
+    if endpoint == 'accept-ap':
+        posts = [race['race']] * 2
+    elif endpoint == 'call-npr':
+        result_id = random.choice(race['result_ids'])
+        posts = [{'race_id': race['race']['race_id'], 'result_id': result_id}] * 2
+    else:
+        posts = [{'call': random.choice(['Dem', 'GOP'])}, {'call': ''}]
+
+    for data in posts:
+        _timed_request(timings, endpoint, session.post, page_url + endpoint, data=data)
+
+
+def _save_calls(officename):
+    """
+    Every call for an office, to be put back with `_restore_calls`
+    """
+    result_ids = models.Result.select(models.Result.id).where(
+        models.Result.officename == officename
+    )
+    calls = list(models.Call.select(
+        models.Call.call_id,
+        models.Call.accept_ap,
+        models.Call.override_winner
+    ).where(
+        models.Call.call_id << result_ids
+    ).tuples())
+    chamber_calls = list(models.RaceMeta.select(
+        models.RaceMeta.result_id,
+        models.RaceMeta.chamber_call_override
+    ).where(
+        models.RaceMeta.result_id << result_ids
+    ).tuples())
+    return calls, chamber_calls
+
+
+def _restore_calls(saved):
+    calls, chamber_calls = saved
+
+    by_call = {}
+    for result_id, accept_ap, override_winner in calls:
+        by_call.setdefault((accept_ap, override_winner), []).append(result_id)
+    by_chamber_call = {}
+    for result_id, chamber_call_override in chamber_calls:
+        by_chamber_call.setdefault(chamber_call_override, []).append(result_id)
+
+    with models.db.atomic():
+        for (accept_ap, override_winner), result_ids in by_call.items():
+            models.Call.update(
+                accept_ap=accept_ap,
+                override_winner=override_winner
+            ).where(
+                models.Call.call_id << result_ids
+            ).execute()
+        for chamber_call_override, result_ids in by_chamber_call.items():
+            models.RaceMeta.update(
+                chamber_call_override=chamber_call_override
+            ).where(
+                models.RaceMeta.result_id << result_ids
+            ).execute()
+
+
+@task
+def calls_admin(url='http://localhost:8000', office='senate', editors='10', duration='60', poll_interval='1', call_interval='5'):
+    """
+    Simulate editors working on a calls page. Each editor loads the
+    page, polls it for changes and makes and undoes calls: accepting
+    AP's call or calling a random race, or calling the chamber. Every
+    call is put back as it was when the test finishes.
+    Start the app first, eg with `fab app:production=true`.
+    """
+    editors = int(editors)
+    duration = float(duration)
+    officename = SLUG_TO_OFFICENAME[office]
+
+    page_url = '{0}/{1}/calls/{2}/'.format(url.rstrip('/'), app_config.PROJECT_SLUG, office)
+    races = {}
+    for result in models.Result.select(
+        models.Result.id,
+        models.Result.raceid,
+        models.Result.statepostal,
+        models.Result.reportingunitname,
+        models.Result.level
+    ).join(
+        # Only the races on the calls page, which have calls to make
+        models.Call,
+        on=(models.Call.call_id == models.Result.id)
+    ).where(
+        models.Result.officename == officename,
+        (models.Result.level == 'state') | (models.Result.level == 'district')
+    ):
+        key = (result.raceid, result.statepostal, result.reportingunitname, result.level)
+        race = races.setdefault(key, {
+            'race': {
+                'race_id': result.raceid,
+                'statepostal': result.statepostal,
+                'reportingunit': result.reportingunitname or '',
+                'level': result.level
+            },
+            'result_ids': []
+        })
+        race['result_ids'].append(result.id)
+    races = list(races.values())
+
+    logger.info('load testing {0} with {1} editors for {2:.0f} seconds'.format(page_url, editors, duration))
+
+    timings = Timings()
+    start = time.time()
+    threads = [
+        threading.Thread(
+            target=_editor,
+            args=(page_url, races, start + duration, float(poll_interval), float(call_interval), timings)
+        )
+        for _ in range(editors)
+    ]
+    saved = _save_calls(officename)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        _restore_calls(saved)
+
+    print(timings.report(time.time() - start))
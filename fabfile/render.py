@@ -1,27 +1,26 @@
 import app_config
+import hashlib
 import logging
-import multiprocessing
+import metrics
 import os
 import re
 import shutil
 import simplejson as json
-import copytext
 
 from datetime import datetime
 from fabric.api import task
-from joblib import Parallel, delayed
 from models import models
 from playhouse.shortcuts import model_to_dict
+from render_utils import load_copy
 from tidylib import tidy_fragment
 
 from . import utils
+from .workers import get_render_executor
 
 logging.basicConfig(format=app_config.LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(app_config.LOG_LEVEL)
 
-NUM_CORES = multiprocessing.cpu_count() * 4
-
 COMMON_SELECTIONS = [
     models.Result.first,
     models.Result.last,
@@ -170,6 +169,7 @@ def _select_ballot_measure_results():
 
 
 @task
+@metrics.timed('render')
 def render_top_level_numbers():
     # init with parties that already have seats
 
@@ -256,29 +256,74 @@ def render_top_level_numbers():
     _write_json_file(data, 'top-level-results.json')
 
 
+# Tidy's errors for get-caught-up markup, by a hash of the markup
+_markup_errors = {}
+MAX_CACHED_MARKUP_ERRORS = 1000
+
+
+def _get_markup_errors(markup):
+    '''
+    Validate a fragment of HTML, only running tidy on markup that it
+    hasn't already seen, since most fields don't change between cycles
+    '''
+    # Formatted the same way it's validated, so that anything the
+    # template below accepts, like None or a number, can be hashed
+    key = hashlib.sha1(('%s' % markup).encode('utf-8')).hexdigest()
+
+    if key not in _markup_errors:
+        if len(_markup_errors) >= MAX_CACHED_MARKUP_ERRORS:
+            _markup_errors.clear()
+
+        # Note that despite its name, tidy_fragment() requires a valid html document or else
+        # it will throw markup validation errors. The documentation at http://countergram.github.io/pytidylib/
+        # did not address this seeming discrepancy.
+        document, errors = tidy_fragment('<!DOCTYPE html><html><head><title>test</title></head><body>%s</body></html>' % markup)
+        _markup_errors[key] = errors
+
+    return _markup_errors[key]
+
+
+# The get-caught-up files last rendered by this process, and the version
+# of the calendar file they were rendered from
+_rendered_get_caught_up = {
+    'version': None,
+    'files': {}
+}
+
+
 @task
+@metrics.timed('render')
 def render_get_caught_up():
     '''
     Render the prose for the get-caught-up info box
     The Google Sheet that powers this will be regularly re-downloaded
     '''
-    copy = copytext.Copy(app_config.CALENDAR_PATH)
+    copy = load_copy(app_config.CALENDAR_PATH)
+
+    # The calendar is only re-written when the sheet changes, so unless
+    # it has, just write out the same files again, stamped as updated
+    # now like every other cycle's
+    if copy.version is not None and copy.version == _rendered_get_caught_up['version']:
+        for filename, data in _rendered_get_caught_up['files'].items():
+            meta = dict(data['meta'], last_updated=datetime.utcnow())
+            _write_json_file(dict(data, meta=meta), filename)
+        return
+
     sheet = copy['get_caught_up']
     serialized_data = json.loads(sheet.json())
 
     is_valid = True
     markup_fields = ['intro_1', 'intro_2', 'bullet_1', 'bullet_2', 'bullet_3', 'bullet_4', 'bullet_5']
     markup_errors_found = None
-    # Note that despite its name, tidy_fragment() requires a valid html document or else
-    # it will throw markup validation errors. The documentation at http://countergram.github.io/pytidylib/
-    # did not address this seeming discrepancy.
     for field in markup_fields:
-        document, errors = tidy_fragment('<!DOCTYPE html><html><head><title>test</title></head><body>%s</body></html>' % serialized_data[field])
+        errors = _get_markup_errors(serialized_data[field])
         if errors:
             is_valid = False
             markup_errors_found = errors
             break
 
+    files = {}
+
     # Don't publish if that option is off, or if a syntax error is found
     if serialized_data.get('published', '').lower() == 'yes' and is_valid:
         meta = {
@@ -288,10 +333,7 @@ def render_get_caught_up():
         }
         content = {k: v.strip() for k, v in serialized_data.items() if k in markup_fields}
 
-        _write_json_file(
-            {'meta': meta, 'content': content},
-            'get-caught-up.json'
-        )
+        files['get-caught-up.json'] = {'meta': meta, 'content': content}
 
     # Publish a debug version to help editors gauge length of content
     # If there are no markup errors and `published` is `True`, the contents
@@ -307,13 +349,19 @@ def render_get_caught_up():
         if k in markup_fields
     } if is_valid else "The HTML markup is invalid. Errors:\n{}".format(markup_errors_found)
 
-    _write_json_file(
-        {'meta': meta, 'content': content},
-        'get-caught-up-debug.json'
-    )
+    files['get-caught-up-debug.json'] = {'meta': meta, 'content': content}
+
+    for filename, data in files.items():
+        _write_json_file(data, filename)
+
+    _rendered_get_caught_up.update({
+        'version': copy.version,
+        'files': files
+    })
 
 
 @task
+@metrics.timed('render')
 def render_county_results(office, special=False):
     states = models.Result.select(models.Result.statepostal).distinct()
 
@@ -344,6 +392,7 @@ def _render_county(statepostal, office, special=False):
 
 
 @task
+@metrics.timed('render')
 def render_governor_results():
     results = _select_governor_results()
 
@@ -352,6 +401,7 @@ def render_governor_results():
 
 
 @task
+@metrics.timed('render')
 def render_house_results():
     results = _select_selected_house_results()
 
@@ -360,6 +410,7 @@ def render_house_results():
 
 
 @task
+@metrics.timed('render')
 def render_senate_results():
     results = _select_senate_results()
 
@@ -368,6 +419,7 @@ def render_senate_results():
 
 
 @task
+@metrics.timed('render')
 def render_ballot_measure_results():
     results = _select_ballot_measure_results()
 
@@ -375,11 +427,20 @@ def render_ballot_measure_results():
     _write_json_file(serialized_results, 'ballot-measures-national.json')
 
 
+# The big board for each office that can be called in the admin
+OFFICE_RENDERERS = {
+    'U.S. Senate': render_senate_results,
+    'U.S. House': render_house_results,
+    'Governor': render_governor_results
+}
+
+
 @task
+@metrics.timed('render')
 def render_state_results():
     states = models.Result.select(models.Result.statepostal).distinct()
 
-    Parallel(n_jobs=NUM_CORES)(delayed(_render_state)(state.statepostal) for state in states)
+    get_render_executor().map(_render_state, [state.statepostal for state in states])
 
 
 def _render_state(statepostal):
@@ -749,18 +810,49 @@ def get_last_updated(serialized_results):
 
 
 def _write_json_file(serialized_results, filename):
-    with open('{0}/{1}'.format(app_config.DATA_OUTPUT_FOLDER, filename), 'w') as f:
-        json.dump(serialized_results, f, use_decimal=True, cls=utils.APDatetimeEncoder)
+    with metrics.timer('file_write'):
+        payload = json.dumps(serialized_results, use_decimal=True, cls=utils.APDatetimeEncoder)
+        with open('{0}/{1}'.format(app_config.DATA_OUTPUT_FOLDER, filename), 'w') as f:
+            f.write(payload)
+
+    metrics.increment('files_written')
+    metrics.increment('bytes_written', len(payload.encode('utf-8')))
 
 
 @task
+@metrics.timed('render')
+def render_calls(officenames, statepostals):
+    """
+    Render only the files that calls for these offices and states change
+    """
+    render_top_level_numbers()
+
+    for officename in officenames:
+        OFFICE_RENDERERS[officename]()
+
+    for statepostal in statepostals:
+        _render_state(statepostal)
+
+
+@task
+@metrics.timed('render')
 def render_all():
     if os.path.isdir(app_config.DATA_OUTPUT_FOLDER):
         shutil.rmtree(app_config.DATA_OUTPUT_FOLDER)
     os.makedirs(app_config.DATA_OUTPUT_FOLDER)
 
-    render_top_level_numbers()
     render_get_caught_up()
+    render_results()
+
+
+@task
+@metrics.timed('render')
+def render_results():
+    """
+    Render every file that's built from results, without clearing the
+    output folder first.
+    """
+    render_top_level_numbers()
 
     render_senate_results()
     render_governor_results()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Replay recorded AP responses through the results pipeline, to see how
+quickly each update is loaded and rendered.
+"""
+
+import app_config
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from datetime import datetime
+from fabric.api import task
+
+from . import data
+from . import render
+from . import utils
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+
+class Replay(object):
+    """
+    Stands in for the AP API, making recorded responses available one
+    after another on the schedule they were recorded on, `speed` times
+    faster, or every `interval` seconds if it's given.
+
+    elex reads whichever response is current from `path`, with `-d`.
+    """
+    def __init__(self, recordings, path, speed=1, interval=None):
+        snapshots = sorted((self._recorded_at(recording), recording) for recording in recordings)
+        self.recordings = [recording for recorded_at, recording in snapshots]
+        first = snapshots[0][0]
+        self.offsets = [
+            i * interval if interval is not None else (recorded_at - first).total_seconds() / speed
+            for i, (recorded_at, recording) in enumerate(snapshots)
+        ]
+        self.path = path
+        self.flag_set = '-d {0}'.format(path)
+        self.started = None
+        self._published = None
+
+    def start(self):
+        self.started = time.time()
+
+    def available_at(self, index):
+        return self.started + self.offsets[index]
+
+    def publish(self):
+        """
+        Put the response that's current now where elex reads it, and
+        return its index.
+        """
+        now = time.time()
+        index = max(i for i, offset in enumerate(self.offsets) if i == 0 or self.started + offset <= now)
+        if index != self._published:
+            tmp_path = '{0}.tmp'.format(self.path)
+            shutil.copyfile(self.recordings[index], tmp_path)
+            os.replace(tmp_path, self.path)
+            self._published = index
+        return index
+
+    @property
+    def last(self):
+        return len(self.recordings) - 1
+
+    def _recorded_at(self, recording):
+        with open(recording) as f:
+            timestamp = json.load(f)['timestamp']
+        return datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def _report(cycles):
+    lines = ['{0:>5} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8}'.format(
+        'cycle', 'response', 'skipped', 'load', 'render', 'latency'
+    )]
+    for cycle in cycles:
+        lines.append('{0:>5} {1:>8} {2:>8} {3:>8.2f} {4:>8} {5:>8}'.format(
+            cycle['cycle'],
+            cycle['response'],
+            cycle['skipped'],
+            cycle['load'],
+            '{0:.2f}'.format(cycle['render']) if cycle['render'] is not None else 'failed',
+            '{0:.2f}'.format(cycle['latency']) if cycle['latency'] is not None else ''
+        ))
+
+    latencies = sorted(cycle['latency'] for cycle in cycles if cycle['latency'] is not None)
+    if latencies:
+        lines.append('latency from response available to JSON written: median {0:.2f}s, max {1:.2f}s over {2} responses'.format(
+            latencies[len(latencies) // 2], latencies[-1], len(latencies)
+        ))
+    return '\n'.join(lines)
+
+
+@task
+def election_night(recordings='tests/recordings/*.json', speed='1', interval='', poll='', output=''):
+    """
+    Replay recorded AP responses through the results pipeline, loading
+    and rendering every `poll` seconds (`LOAD_RESULTS_INTERVAL` by
+    default) like the daemon does, and report how long each response
+    took to get from being available to being written out as JSON.
+
+    Responses are replayed on the schedule they were recorded on,
+    `speed` times faster, or every `interval` seconds. The first one is
+    loaded, and calls and race metadata created from it, before the
+    clock starts. JSON is rendered to a temporary folder, or to `output`.
+    """
+    utils.confirm('This replaces all results, calls and race metadata in the {0} database. Continue?'.format(
+        app_config.database['PGDATABASE']
+    ))
+
+    recordings = glob.glob(recordings)
+    if not recordings:
+        logger.error('no recordings to replay')
+        return
+
+    poll = float(poll) if poll else app_config.LOAD_RESULTS_INTERVAL
+    folder = tempfile.mkdtemp()
+    replay = Replay(
+        recordings,
+        os.path.join(folder, 'ap.json'),
+        speed=float(speed),
+        interval=float(interval) if interval else None
+    )
+
+    elex_output_folder = app_config.ELEX_OUTPUT_FOLDER
+    output_folder = app_config.DATA_OUTPUT_FOLDER
+    app_config.ELEX_OUTPUT_FOLDER = os.path.join(folder, 'elex')
+    app_config.DATA_OUTPUT_FOLDER = output or os.path.join(folder, 'rendered')
+    if not os.path.isdir(app_config.DATA_OUTPUT_FOLDER):
+        os.makedirs(app_config.DATA_OUTPUT_FOLDER)
+
+    cycles = []
+    try:
+        replay.start()
+        replay.publish()
+
+        # The same as bootstrapping the database with initialization data
+        if not data.load_results(flag_sets=[replay.flag_set]):
+            return
+        data.create_calls()
+        data.create_race_meta()
+
+        replay.start()
+        loaded = None
+        while True:
+            cycle_start = time.time()
+            index = replay.publish()
+
+            if data.load_results(flag_sets=[replay.flag_set]):
+                load_end = time.time()
+                render.render_results()
+                rendered = time.time()
+                render_seconds = rendered - load_end
+            else:
+                load_end = time.time()
+                render_seconds = None
+
+            cycle = {
+                'cycle': len(cycles) + 1,
+                'response': index + 1,
+                'skipped': 0,
+                'load': load_end - cycle_start,
+                'render': render_seconds,
+                'latency': None
+            }
+            # Only the first cycle to pick up a response measures its
+            # latency; responses replaced before any cycle saw them are
+            # counted as skipped
+            if index != loaded and render_seconds is not None:
+                cycle['skipped'] = index - (loaded + 1 if loaded is not None else 0)
+                cycle['latency'] = rendered - replay.available_at(index)
+                loaded = index
+            cycles.append(cycle)
+            logger.info('cycle {0}: response {1} of {2}'.format(cycle['cycle'], index + 1, replay.last + 1))
+
+            if loaded == replay.last:
+                break
+            if index == replay.last and render_seconds is None:
+                logger.critical('the last response could not be loaded')
+                break
+
+            time.sleep(max(0, cycle_start + poll - time.time()))
+    finally:
+        app_config.ELEX_OUTPUT_FOLDER = elex_output_folder
+        app_config.DATA_OUTPUT_FOLDER = output_folder
+        shutil.rmtree(folder)
+
+    print(_report(cycles))
@@ -4,8 +4,12 @@ Commands related to syncing docs and spreadsheets from Google Drive.
 """
 
 import logging
+import multiprocessing
+import threading
+import time
 
 import app_config
+import metrics
 
 from fabric.api import parallel, task
 from oauth import get_document
@@ -29,10 +33,14 @@ def update():
 @parallel
 def update_in_parallel():
     '''
-    Update the tabular data in the background
+    Update the tabular data in the background. Returns whether the
+    calendar changed.
     '''
     try:
-        update_calendar()
+        changed = update_calendar()
+        if not changed:
+            logger.info('calendar unchanged, skipped download')
+        return changed
     except KeyError as e:
         message = str(e)
         # Allow `500` errors, since Google sometimes fails on its end,
@@ -47,9 +55,9 @@ def update_in_parallel():
 
 def update_copytext():
     """
-    Downloads a Google Doc as an Excel file.
+    Downloads a Google Doc as an Excel file, if it changed.
     """
-    get_document(
+    return get_document(
         app_config.COPY_GOOGLE_DOC_KEY,
         app_config.COPY_PATH
     )
@@ -57,9 +65,77 @@ def update_copytext():
 
 def update_calendar():
     """
-    Download calendar file.
+    Download calendar file, if it changed.
     """
-    get_document(
+    return get_document(
         app_config.CALENDAR_GOOGLE_DOC_KEY,
         app_config.CALENDAR_PATH
     )
+
+
+def _refresh_in_child(conn):
+    try:
+        conn.send(update_in_parallel())
+    finally:
+        conn.close()
+
+
+class SheetRefresher(object):
+    """
+    Refresh the calendar in a background thread, on its own schedule,
+    so that a slow response from Google never holds up results.
+
+    Each refresh runs in a child process, which is killed if it takes
+    longer than `timeout` seconds. Downloads replace files in one step,
+    so everything else keeps reading the last complete copy.
+    """
+    def __init__(self, interval, timeout):
+        self.interval = interval
+        self.timeout = timeout
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sheet-refresher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self.interval)
+
+    def refresh(self):
+        """
+        Refresh the calendar once. Returns whether it changed, or `None`
+        if the refresh failed or timed out.
+        """
+        start = time.time()
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.get_context('fork').Process(target=_refresh_in_child, args=(child_conn,))
+        process.start()
+        child_conn.close()
+
+        changed = None
+        if parent_conn.poll(self.timeout):
+            try:
+                changed = parent_conn.recv()
+            except EOFError:
+                # The child exited without a result; it will have logged why
+                metrics.increment('sheet_refresh_failures')
+        else:
+            logger.warning('sheet refresh timed out after {0} seconds'.format(self.timeout))
+            metrics.increment('sheet_refresh_timeouts')
+            process.terminate()
+
+        process.join()
+        parent_conn.close()
+
+        if changed is not None:
+            metrics.increment('sheet_refreshes', result='changed' if changed else 'unchanged')
+        metrics.observe('sheet_refresh', time.time() - start)
+
+        return changed
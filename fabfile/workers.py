@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+A pool of render worker processes, kept warm across daemon cycles.
+"""
+
+import app_config
+import atexit
+import logging
+import math
+import metrics
+import multiprocessing
+import os
+import time
+
+from models import models
+from models.profiler import profiler
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+# Never run more than this many workers per core, however much time
+# the workers spend waiting on the database
+MAX_WORKERS_PER_CORE = 2
+
+
+def _init_worker():
+    # Workers are forked from the daemon, and must not share its
+    # database connections
+    models.db.reset_after_fork()
+
+
+def _timed_call(func_and_arg):
+    func, arg = func_and_arg
+
+    # Only report what this task recorded
+    metrics.registry.reset()
+    profiler.reset()
+
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    func(arg)
+
+    return {
+        'key': arg,
+        'pid': os.getpid(),
+        'wall': time.time() - start_wall,
+        'cpu': time.process_time() - start_cpu,
+        'metrics': metrics.registry.dump(),
+        'profile': profiler.dump() if profiler.enabled else None
+    }
+
+
+class RenderExecutor(object):
+    """
+    Run render tasks on a bounded set of forked workers.
+
+    Unless `workers` is given, the pool starts with one worker per core,
+    and after each batch is resized from the measured ratio of CPU time
+    to wall time: tasks that mostly wait on Postgres get more workers,
+    tasks that are CPU-bound get one per core.
+    """
+    def __init__(self, workers=None):
+        self.cpu_count = multiprocessing.cpu_count()
+        self.fixed_workers = workers
+        self.workers = workers or self.cpu_count
+        self.pool = None
+        self.last_timings = []
+
+    def map(self, func, args):
+        """
+        Call `func` once per item of `args` on the workers, and return
+        the per-task timings. `func` must be a module-level function.
+        """
+        if self.pool is None:
+            logger.info('starting {0} render workers'.format(self.workers))
+            context = multiprocessing.get_context('fork')
+            self.pool = context.Pool(self.workers, initializer=_init_worker)
+
+        start = time.time()
+        timings = self.pool.map(_timed_call, [(func, arg) for arg in args], chunksize=1)
+        elapsed = time.time() - start
+
+        for timing in timings:
+            metrics.registry.merge(timing.pop('metrics'))
+            profile = timing.pop('profile')
+            if profile:
+                profiler.merge(profile)
+            metrics.observe('worker_task', timing['wall'], task=func.__name__)
+
+        self.last_timings = timings
+        self._log_timings(func, timings, elapsed)
+
+        if not self.fixed_workers:
+            self._resize(timings)
+
+        return timings
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _log_timings(self, func, timings, elapsed):
+        for timing in sorted(timings, key=lambda t: t['wall'], reverse=True):
+            logger.debug('{0}({1}): {2:.3f}s wall, {3:.3f}s cpu, pid {4}'.format(
+                func.__name__,
+                timing['key'],
+                timing['wall'],
+                timing['cpu'],
+                timing['pid']
+            ))
+        logger.info('{0}: {1} tasks on {2} workers in {3:.3f}s'.format(
+            func.__name__,
+            len(timings),
+            self.workers,
+            elapsed
+        ))
+
+    def _resize(self, timings):
+        wall = sum(t['wall'] for t in timings)
+        cpu = sum(t['cpu'] for t in timings)
+        if not wall or not cpu:
+            return
+
+        cpu_ratio = min(cpu / wall, 1.0)
+        ideal = int(math.ceil(self.cpu_count / cpu_ratio))
+        ideal = max(1, min(ideal, self.cpu_count * MAX_WORKERS_PER_CORE))
+
+        # Avoid respawning workers over small fluctuations
+        if abs(ideal - self.workers) > 1:
+            logger.info('resizing render workers from {0} to {1} (cpu/wall {2:.2f})'.format(
+                self.workers,
+                ideal,
+                cpu_ratio
+            ))
+            self.close()
+            self.workers = ideal
+
+
+_executor = None
+
+
+def get_render_executor():
+    """
+    Return the process-wide executor, creating it on first use.
+    """
+    global _executor
+
+    if _executor is None:
+        _executor = RenderExecutor(workers=app_config.RENDER_WORKERS)
+        atexit.register(_executor.close)
+
+    return _executor
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""
+Timers and counters for the results pipeline and the admin app.
+
+The daemon records into the module-level registry over the course of a
+cycle, then logs the cycle as one JSON line and saves a snapshot to
+`app_config.METRICS_PATH`, where the admin app's `/metrics` endpoint
+picks it up.
+
+Each admin-app worker keeps its own registry, and saves it next to the
+daemon's snapshot every few seconds, so that whichever worker answers
+`/metrics` can report the totals for all of them.
+"""
+
+import app_config
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+METRIC_PREFIX = app_config.PROJECT_FILENAME
+
+# Seconds between saves of each admin-app worker's registry
+WORKER_SNAPSHOT_INTERVAL = 5
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class Registry(object):
+    """
+    Counters, gauges and timers, each identified by a name and labels.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+
+    def increment(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            timer = self.timers.setdefault(key, {'count': 0, 'sum': 0.0, 'max': 0.0, 'last': 0.0})
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            timer['last'] = seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator that times each call, labelled with the function name.
+        """
+        def decorator(func):
+            @wraps(func)
+            def inner(*args, **kwargs):
+                with self.timer(name, task=func.__name__, **labels):
+                    return func(*args, **kwargs)
+            return inner
+        return decorator
+
+    def dump(self):
+        """
+        Return the registry's contents as JSON-serializable lists.
+        """
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, dict(labels), value] for (name, labels), value in self.gauges.items()],
+                'timers': [[name, dict(labels), dict(timer)] for (name, labels), timer in self.timers.items()]
+            }
+
+    def merge(self, dumped):
+        """
+        Add the contents of another registry's `dump()`, for example
+        from a render worker process.
+        """
+        for name, labels, value in dumped['counters']:
+            self.increment(name, value, **labels)
+        for name, labels, value in dumped['gauges']:
+            self.set_gauge(name, value, **labels)
+        for name, labels, other in dumped['timers']:
+            key = _key(name, labels)
+            with self._lock:
+                timer = self.timers.setdefault(key, {'count': 0, 'sum': 0.0, 'max': 0.0, 'last': 0.0})
+                timer['count'] += other['count']
+                timer['sum'] += other['sum']
+                timer['max'] = max(timer['max'], other['max'])
+                timer['last'] = other['last']
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    )
+
+
+def to_prometheus(dumped, **extra_labels):
+    """
+    Render a registry dump in the Prometheus text exposition format.
+    """
+    lines = []
+
+    for name, labels, value in sorted(dumped['counters'], key=lambda m: m[0]):
+        labels = dict(labels, **extra_labels)
+        lines.append('{0}_{1}_total{2} {3}'.format(METRIC_PREFIX, name, _format_labels(labels), value))
+
+    for name, labels, value in sorted(dumped['gauges'], key=lambda m: m[0]):
+        labels = dict(labels, **extra_labels)
+        lines.append('{0}_{1}{2} {3}'.format(METRIC_PREFIX, name, _format_labels(labels), value))
+
+    for name, labels, timer in sorted(dumped['timers'], key=lambda m: m[0]):
+        labels = _format_labels(dict(labels, **extra_labels))
+        for stat in ('count', 'sum', 'max', 'last'):
+            lines.append('{0}_{1}_seconds_{2}{3} {4}'.format(METRIC_PREFIX, name, stat, labels, timer[stat]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def save_snapshot(dumped, path=None):
+    """
+    Atomically write a registry dump to disk.
+    """
+    path = path or app_config.METRICS_PATH
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dumped, f)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path=None):
+    """
+    Read a registry dump written by `save_snapshot`, if there is one.
+    """
+    path = path or app_config.METRICS_PATH
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _workers_folder(path=None):
+    return os.path.join(os.path.dirname(path or app_config.METRICS_PATH), 'app-workers')
+
+
+def clear_worker_snapshots(path=None):
+    """
+    Forget every app worker's saved registry, eg when the app starts.
+    """
+    folder = _workers_folder(path)
+    if os.path.isdir(folder):
+        for filename in os.listdir(folder):
+            os.remove(os.path.join(folder, filename))
+
+
+def save_worker_snapshot(force=False, path=None):
+    """
+    Save this process's registry for the other app workers, at most
+    once every `WORKER_SNAPSHOT_INTERVAL` seconds unless `force` is set.
+    """
+    global _worker_saved
+    if not force and time.time() - _worker_saved < WORKER_SNAPSHOT_INTERVAL:
+        return
+    _worker_saved = time.time()
+
+    try:
+        save_snapshot(registry.dump(), os.path.join(_workers_folder(path), '{0}.json'.format(os.getpid())))
+    except (IOError, OSError) as e:
+        logger.warning('could not save worker metrics snapshot: {0}'.format(e))
+
+
+def load_worker_snapshots(path=None):
+    """
+    Return every app worker's saved registry, by process ID.
+    """
+    folder = _workers_folder(path)
+    snapshots = {}
+    if os.path.isdir(folder):
+        for filename in os.listdir(folder):
+            worker, extension = os.path.splitext(filename)
+            if extension == '.json':
+                dumped = load_snapshot(os.path.join(folder, filename))
+                if dumped:
+                    snapshots[worker] = dumped
+    return snapshots
+
+
+def merge_workers(snapshots):
+    """
+    Combine app workers' registries into one dump. Counters and timers
+    are added up, including those of workers that have since exited, so
+    counters never go backwards between scrapes. Gauges only make sense
+    for a single process, so they're labelled with their worker.
+    """
+    merged = Registry()
+    for worker, dumped in sorted(snapshots.items()):
+        merged.merge({
+            'counters': dumped['counters'],
+            'gauges': [[name, dict(labels, worker=worker), value] for name, labels, value in dumped['gauges']],
+            'timers': dumped['timers']
+        })
+    return merged.dump()
+
+
+registry = Registry()
+
+# When this app worker last saved its registry
+_worker_saved = 0
+
+# Everything the daemon has recorded since it started
+totals = Registry()
+
+increment = registry.increment
+set_gauge = registry.set_gauge
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+
+
+def end_cycle(**fields):
+    """
+    Fold the current cycle into the running totals, log it as a single
+    JSON line, save a snapshot for the admin app, and start a new cycle.
+    """
+    cycle = registry.dump()
+    totals.merge(cycle)
+    registry.reset()
+
+    summary = {
+        'cycle_finished': time.time(),
+        'stages': {
+            '.'.join([name] + [str(v) for k, v in sorted(labels.items())]): round(timer['sum'], 4)
+            for name, labels, timer in cycle['timers']
+        },
+        'counters': {
+            '.'.join([name] + [str(v) for k, v in sorted(labels.items())]): value
+            for name, labels, value in cycle['counters']
+        }
+    }
+    summary.update(fields)
+    logger.info(json.dumps(summary, sort_keys=True))
+
+    snapshot = totals.dump()
+    snapshot['last_cycle'] = summary
+    try:
+        save_snapshot(snapshot)
+    except (IOError, OSError) as e:
+        logger.warning('could not save metrics snapshot: {0}'.format(e))
+
+    return summary
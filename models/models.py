@@ -1,8 +1,15 @@
 import app_config
+import metrics
+import os
+import threading
+import time
 
-from peewee import Model, PostgresqlDatabase
+from peewee import Model, _ConnectionLocal
 from peewee import BooleanField, CharField, DateField, DateTimeField, DecimalField, ForeignKeyField, IntegerField, fn
 from playhouse.hybrid import hybrid_property
+from playhouse.pool import PooledPostgresqlDatabase
+
+from .profiler import profiler
 
 import logging
 logger = logging.getLogger('peewee')
@@ -10,14 +17,107 @@ logger.setLevel(logging.WARNING)
 logger.addHandler(logging.StreamHandler())
 
 
-db = PostgresqlDatabase(
+class ElectionsDatabase(PooledPostgresqlDatabase):
+    """
+    Connection pool that is private to each process, and that keeps
+    track of how long callers wait to check out a connection.
+
+    Render workers are forked from the daemon, and uwsgi workers from
+    its master, so a child must never reuse (or close) a connection
+    that it inherited from its parent; the pool is emptied instead.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ElectionsDatabase, self).__init__(*args, **kwargs)
+        self._pid = os.getpid()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0
+        }
+
+    def pool_stats(self):
+        """
+        Return pool counters and sizes for this process.
+        """
+        stats = dict(self._stats)
+        stats['in_use'] = len(self._in_use)
+        stats['idle'] = len(self._connections)
+        stats['max_connections'] = self.max_connections
+        return stats
+
+    def reset_after_fork(self):
+        """
+        Forget every connection inherited from the parent process.
+        Inherited sockets are left open, since closing them would
+        terminate the parent's sessions.
+        """
+        self._pid = os.getpid()
+        self._conn_lock = threading.Lock()
+        self._local = _ConnectionLocal()
+        self._connections = []
+        self._in_use = {}
+        self._closed = set()
+        self.reset_stats()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self.reset_after_fork()
+
+    def get_conn(self):
+        self._check_pid()
+        return super(ElectionsDatabase, self).get_conn()
+
+    def connect(self):
+        self._check_pid()
+        start = time.time()
+        try:
+            super(ElectionsDatabase, self).connect()
+        finally:
+            self._record_wait(time.time() - start)
+
+    def _connect(self, *args, **kwargs):
+        self._check_pid()
+        idle = set(self.conn_key(conn) for _, conn in self._connections)
+        conn = super(ElectionsDatabase, self)._connect(*args, **kwargs)
+        self._stats['checkouts'] += 1
+        if self.conn_key(conn) not in idle:
+            self._stats['connections_created'] += 1
+        return conn
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        metrics.increment('db_queries')
+        if not profiler.enabled:
+            return super(ElectionsDatabase, self).execute_sql(sql, params, require_commit)
+
+        start = time.time()
+        try:
+            return super(ElectionsDatabase, self).execute_sql(sql, params, require_commit)
+        finally:
+            profiler.record(sql, params, time.time() - start)
+
+    def _record_wait(self, seconds):
+        self._stats['wait_seconds_total'] += seconds
+        self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], seconds)
+
+
+db = ElectionsDatabase(
     app_config.database['PGDATABASE'],
+    max_connections=app_config.DATABASE_MAX_CONNECTIONS,
+    stale_timeout=app_config.DATABASE_STALE_TIMEOUT,
+    timeout=app_config.DATABASE_POOL_TIMEOUT,
     user=app_config.database['PGUSER'],
     password=app_config.database['PGPASSWORD'],
     host=app_config.database['PGHOST'],
     port=app_config.database['PGPORT']
 )
 
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=db.reset_after_fork)
+
 
 class BaseModel(Model):
     """
@@ -0,0 +1,159 @@
+"""
+Opt-in SQL profiling for `models.db`.
+
+When `app_config.SQL_PROFILE` is on (or the `SQL_PROFILE` environment
+variable is set), every query is counted against the first function
+outside of `peewee` that issued it, and the slowest statements are kept
+so that their query plans can be reported.
+"""
+
+import app_config
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Frames from these files are never reported as the caller of a query
+IGNORED_CALLER_FILES = ('peewee.py', 'playhouse', os.path.join('models', 'profiler.py'))
+IGNORED_CALLER_FUNCTIONS = ('execute_sql',)
+
+
+def _find_caller():
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not any(ignored in filename for ignored in IGNORED_CALLER_FILES) and \
+                frame.f_code.co_name not in IGNORED_CALLER_FUNCTIONS:
+            return '{0}:{1}'.format(os.path.relpath(filename, ROOT_PATH), frame.f_code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryProfiler(object):
+    def __init__(self, enabled=False, slowest_count=10):
+        self.enabled = enabled
+        self.slowest_count = slowest_count
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.by_caller = {}
+            self.slowest = []
+
+    def record(self, sql, params, seconds):
+        caller = _find_caller()
+        with self._lock:
+            count, total = self.by_caller.get(caller, (0, 0.0))
+            self.by_caller[caller] = (count + 1, total + seconds)
+
+            self._keep_if_slow((seconds, next(self._sequence), caller, sql, params))
+
+    def dump(self):
+        with self._lock:
+            return {
+                'by_caller': dict(self.by_caller),
+                'slowest': [list(entry) for entry in self.slowest]
+            }
+
+    def merge(self, dumped):
+        """
+        Add the contents of another profiler's `dump()`, for example
+        from a render worker process.
+        """
+        with self._lock:
+            for caller, (count, total) in dumped['by_caller'].items():
+                old_count, old_total = self.by_caller.get(caller, (0, 0.0))
+                self.by_caller[caller] = (old_count + count, old_total + total)
+
+            for seconds, _, caller, sql, params in dumped['slowest']:
+                self._keep_if_slow((seconds, next(self._sequence), caller, sql, params))
+
+    def _keep_if_slow(self, entry):
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def report(self, database, explain=True):
+        """
+        Return a plain-text report of query counts per caller and the
+        slowest statements, with their `EXPLAIN` plans, then reset.
+        """
+        dumped = self.dump()
+        self.reset()
+
+        by_caller = sorted(dumped['by_caller'].items(), key=lambda c: c[1][0], reverse=True)
+        lines = [
+            'SQL profile: {0} queries, {1:.3f}s'.format(
+                sum(count for count, _ in dumped['by_caller'].values()),
+                sum(total for _, total in dumped['by_caller'].values())
+            ),
+            '',
+            'Queries per caller:'
+        ]
+        for caller, (count, total) in by_caller:
+            lines.append('{0:>8} {1:>10.3f}s  {2}'.format(count, total, caller))
+
+        lines.extend(['', 'Slowest statements:'])
+        for seconds, _, caller, sql, params in sorted(dumped['slowest'], reverse=True):
+            lines.extend(['', '{0:.4f}s from {1}'.format(seconds, caller), sql, 'params: {0}'.format(params)])
+            if explain and sql.lstrip().upper().startswith('SELECT'):
+                lines.extend(self._explain(database, sql, params))
+
+        return '\n'.join(lines)
+
+    def _explain(self, database, sql, params):
+        # Don't profile the profiler's own queries
+        self.enabled, was_enabled = False, self.enabled
+        try:
+            cursor = database.execute_sql('EXPLAIN ' + sql, params)
+            return ['    ' + row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            return ['    EXPLAIN failed: {0}'.format(e)]
+        finally:
+            self.enabled = was_enabled
+
+    def save_report(self, database, path=None):
+        """
+        Write a report to `app_config.SQL_PROFILE_PATH`, and log it.
+        """
+        path = path or app_config.SQL_PROFILE_PATH
+        report = self.report(database)
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            f.write('Generated {0}\n\n'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+            f.write(report)
+
+        logger.info(report)
+        return report
+
+
+profiler = QueryProfiler(
+    enabled=app_config.SQL_PROFILE,
+    slowest_count=app_config.SQL_PROFILE_SLOWEST_COUNT
+)
+
+
+def _report_at_exit():
+    # Covers one-off Fabric tasks, which don't run in the daemon's loop
+    from models.models import db
+    if profiler.enabled and profiler.by_caller:
+        profiler.save_report(db)
+
+
+atexit.register(_report_at_exit)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Change notifications between the daemon and the admin app, sent over
+Postgres' `LISTEN`/`NOTIFY`.
+
+Notifications sent inside a transaction are only delivered once it
+commits, so listeners never hear about a change before they can read it.
+"""
+
+import app_config
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from models import models
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+CHANNEL = '{0}_updates'.format(app_config.PROJECT_FILENAME)
+
+# Seconds between checks for a closed listener connection
+LISTEN_POLL_INTERVAL = 5
+RECONNECT_DELAY = 5
+
+
+def publish(event_type, **fields):
+    """
+    Notify listeners that something changed, eg `publish('calls', officename='Governor')`.
+    """
+    payload = dict(fields, type=event_type)
+    models.db.execute_sql('SELECT pg_notify(%s, %s)', (CHANNEL, json.dumps(payload)))
+
+
+class Listener(object):
+    """
+    A single `LISTEN` connection per process, whose notifications are
+    copied to a queue for each subscriber.
+    """
+    def __init__(self, channel=CHANNEL):
+        self.channel = channel
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self):
+        with self._lock:
+            # Threads don't survive a fork, so check which process started it
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._subscribers = set()
+                self._thread = threading.Thread(target=self._run, name='notifications-listener')
+                self._thread.daemon = True
+                self._thread.start()
+
+            subscriber = queue.Queue()
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            dbname=app_config.database['PGDATABASE'],
+            user=app_config.database['PGUSER'],
+            password=app_config.database['PGPASSWORD'],
+            host=app_config.database['PGHOST'],
+            port=app_config.database['PGPORT']
+        )
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute('LISTEN {0};'.format(self.channel))
+        return conn
+
+    def _run(self):
+        while True:
+            try:
+                conn = self._connect()
+                try:
+                    self._listen(conn)
+                finally:
+                    conn.close()
+            except psycopg2.Error as e:
+                logger.warning('notification listener lost its connection: {0}'.format(e))
+                time.sleep(RECONNECT_DELAY)
+
+    def _listen(self, conn):
+        while True:
+            if select.select([conn], [], [], LISTEN_POLL_INTERVAL) == ([], [], []):
+                continue
+
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                try:
+                    event = json.loads(notify.payload)
+                except ValueError:
+                    logger.warning('ignoring malformed notification: {0}'.format(notify.payload))
+                    continue
+
+                with self._lock:
+                    subscribers = list(self._subscribers)
+                for subscriber in subscribers:
+                    subscriber.put(event)
+
+
+listener = Listener()
@@ -8,6 +8,7 @@ from functools import wraps
 from render_utils import make_context
 
 SPREADSHEET_URL_TEMPLATE = 'https://docs.google.com/feeds/download/spreadsheets/Export?exportFormat=xlsx&key=%s'
+DRIVE_FILE_URL_TEMPLATE = 'https://www.googleapis.com/drive/v3/files/%s?fields=version'
 
 oauth = Blueprint('_oauth', __name__)
 
@@ -106,9 +107,18 @@ def save_credentials(credentials):
 
 def get_document(key, file_path):
     """
-    Uses Authomatic to get the google doc
+    Uses Authomatic to get the google doc, unless the copy at `file_path`
+    is already the latest version. Returns whether the file changed.
     """
     credentials = get_credentials()
+    version_path = '{0}.version'.format(file_path)
+
+    # Drive bumps a file's version number with every edit, so compare it
+    # to the version that was last downloaded before exporting again
+    version = _get_document_version(credentials, key)
+    if version is not None and os.path.exists(file_path) and _read_version(version_path) == version:
+        return False
+
     url = SPREADSHEET_URL_TEMPLATE % key
     response = app_config.authomatic.access(credentials, url)
 
@@ -118,8 +128,51 @@ def get_document(key, file_path):
         else:
             raise KeyError("Error! Google returned a %s error" % response.status)
 
-    with open(file_path, 'wb') as writefile:
-        writefile.write(response.content)
+    # Replace files in one step, so that a download that's cut off never
+    # leaves a partial file behind for the renderers to read
+    changed = _read_file(file_path) != response.content
+    if changed:
+        _write_file_atomically(file_path, response.content)
+
+    if version is not None:
+        _write_file_atomically(version_path, version.encode('utf-8'))
+    elif os.path.exists(version_path):
+        os.remove(version_path)
+
+    return changed
+
+
+def _get_document_version(credentials, key):
+    """
+    Drive's version number for a file, or `None` if it can't be read
+    """
+    response = app_config.authomatic.access(credentials, DRIVE_FILE_URL_TEMPLATE % key)
+    if response.status != 200 or not response.data or 'version' not in response.data:
+        return None
+    return str(response.data['version'])
+
+
+def _read_version(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _write_file_atomically(path, content):
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _read_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
 
 
 def _has_api_credentials():
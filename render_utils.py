@@ -4,6 +4,8 @@ import codecs
 from datetime import datetime
 import json
 import logging
+import os
+import threading
 import time
 import urllib
 import subprocess
@@ -157,6 +159,114 @@ class CSSIncluder(Includer):
 
         return '\n'.join(output)
 
+class CopyRowView(object):
+    """
+    A read-only view of a row of a shared copytext sheet.
+    """
+    __slots__ = ('_row',)
+
+    def __init__(self, row):
+        self._row = row
+
+    def __getitem__(self, i):
+        return self._row[i]
+
+    def __iter__(self):
+        return iter(tuple(self._row))
+
+    def __len__(self):
+        return len(self._row)
+
+    def __str__(self):
+        return str(self._row)
+
+    def __html__(self):
+        return self._row.__html__()
+
+    def __bool__(self):
+        return bool(self._row)
+
+
+class CopySheetView(object):
+    """
+    A read-only view of a shared copytext sheet, whose rows are
+    read-only views too.
+    """
+    __slots__ = ('_sheet',)
+
+    def __init__(self, sheet):
+        self._sheet = sheet
+
+    @property
+    def name(self):
+        return self._sheet.name
+
+    def __getitem__(self, i):
+        row = self._sheet[i]
+        if isinstance(row, copytext.Row):
+            return CopyRowView(row)
+        return row
+
+    def __iter__(self):
+        return (CopyRowView(row) for row in self._sheet)
+
+    def __len__(self):
+        return len(self._sheet)
+
+    def json(self):
+        return self._sheet.json()
+
+
+class CachedCopy(object):
+    """
+    A parsed copytext workbook, shared by everything that loads the
+    same file through `load_copy`. Its sheets are only handed out as
+    read-only views, and its JSON is serialized once.
+    """
+    def __init__(self, copy, version):
+        self._copy = copy
+        self.version = version
+        self._json = None
+
+    def __getitem__(self, name):
+        sheet = self._copy[name]
+        if isinstance(sheet, copytext.Sheet):
+            return CopySheetView(sheet)
+        return sheet
+
+    def json(self):
+        if self._json is None:
+            self._json = self._copy.json()
+        return self._json
+
+    def js(self):
+        """
+        The workbook as a script that sets `window.COPY`.
+        """
+        return 'window.COPY = ' + self.json()
+
+# Parsed workbooks, by path
+_copies = {}
+_copies_lock = threading.Lock()
+
+def load_copy(path):
+    """
+    Return the copytext workbook at `path`, only parsing the xlsx again
+    once the file's modification time or size has changed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # Let copytext explain where the file should come from
+        return CachedCopy(copytext.Copy(path), None)
+
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _copies_lock:
+        cached = _copies.get(path)
+        if cached is None or cached.version != version:
+            cached = _copies[path] = CachedCopy(copytext.Copy(path), version)
+        return cached
+
 def flatten_app_config():
     """
     Returns a copy of app_config containing only
@@ -1,25 +1,142 @@
 #!/usr/bin/env python
 
+import hashlib
 import json
+from datetime import datetime
 from mimetypes import guess_type
 import os
 import subprocess
+import threading
 
-from flask import abort, make_response
+from flask import abort, make_response, request
 
 import app_config
-import copytext
 from flask import Blueprint
-from render_utils import BetterJSONEncoder, flatten_app_config
+from render_utils import BetterJSONEncoder, flatten_app_config, load_copy
 
 static = Blueprint('static', __name__)
 
+# Compiled LESS and JST output, by name, with the fingerprint of the
+# sources it was compiled from
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+def _fingerprint(folder, dependencies=()):
+    """
+    Identify the current state of the files in a folder, and of any other
+    files they depend on, by their paths, modification times and sizes.
+    Also returns the latest modification.
+    """
+    paths = set(dependencies)
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            paths.add(os.path.join(root, name))
+
+    stats = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+            stats.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stats.append((path, 0, -1))
+
+    fingerprint = hashlib.md5(repr(stats).encode('utf-8')).hexdigest()
+    last_modified = max([mtime for _, mtime, _ in stats] or [0]) / 1e9
+    return fingerprint, last_modified
+
+def _dependencies_path(name):
+    return os.path.join(app_config.STATIC_CACHE_FOLDER, '{0}.deps'.format(name))
+
+def _load_dependencies(name):
+    """
+    The files outside its source folder that `name` was last compiled
+    from, as recorded by whichever process compiled it.
+    """
+    try:
+        with open(_dependencies_path(name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+def _save_dependencies(name, dependencies):
+    path = _dependencies_path(name)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dependencies, f)
+    os.replace(tmp_path, path)
+
+def _parse_depends(output):
+    """
+    The files listed by `lessc --depends`, which prints a makefile rule,
+    `<output>: <import> <import> ...`
+    """
+    rule = output.decode('utf-8').split(':', 1)
+    return rule[1].split() if len(rule) > 1 else []
+
+def _compile(name, source_folder, command, depends_command=None):
+    """
+    Return the output of a compiler command, only running it again once
+    a file in `source_folder`, a file it imports from elsewhere (as
+    listed by `depends_command`) or the compiler itself has changed.
+    Output is kept in memory and on disk, so other app processes can
+    reuse it.
+    """
+    if not os.path.isdir(app_config.STATIC_CACHE_FOLDER):
+        os.makedirs(app_config.STATIC_CACHE_FOLDER, exist_ok=True)
+
+    dependencies = [command[0]] + _load_dependencies(name)
+    fingerprint, last_modified = _fingerprint(source_folder, dependencies)
+
+    with _compiled_lock:
+        compiled = _compiled.get(name)
+    if compiled and compiled[0] == fingerprint:
+        return compiled
+
+    path = os.path.join(app_config.STATIC_CACHE_FOLDER, '{0}.{1}'.format(name, fingerprint))
+    try:
+        with open(path, 'rb') as f:
+            output = f.read()
+    except IOError:
+        output = subprocess.check_output(command)
+
+        # Imports may have changed along with the sources
+        if depends_command:
+            imports = _parse_depends(subprocess.check_output(depends_command))
+            _save_dependencies(name, imports)
+            fingerprint, last_modified = _fingerprint(source_folder, [command[0]] + imports)
+            path = os.path.join(app_config.STATIC_CACHE_FOLDER, '{0}.{1}'.format(name, fingerprint))
+
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(output)
+        os.replace(tmp_path, path)
+
+        # Clear out output compiled from older sources
+        for filename in os.listdir(app_config.STATIC_CACHE_FOLDER):
+            if filename.startswith(name + '.') and filename not in (os.path.basename(path), name + '.deps') \
+                    and not filename.endswith('.tmp'):
+                os.remove(os.path.join(app_config.STATIC_CACHE_FOLDER, filename))
+
+    compiled = (fingerprint, last_modified, output)
+    with _compiled_lock:
+        _compiled[name] = compiled
+    return compiled
+
+def _compiled_response(compiled, content_type):
+    fingerprint, last_modified, output = compiled
+
+    response = make_response(output, 200, { 'Content-Type': content_type })
+    response.set_etag(fingerprint)
+    response.last_modified = datetime.utcfromtimestamp(last_modified)
+
+    return response.make_conditional(request)
+
 # Render JST templates on-demand
 @static.route('/js/templates.js')
 def _templates_js():
-    r = subprocess.check_output(["node_modules/universal-jst/bin/jst.js", "--template", "underscore", "jst"])
+    compiled = _compile('templates.js', 'jst', ["node_modules/universal-jst/bin/jst.js", "--template", "underscore", "jst"])
 
-    return make_response(r, 200, { 'Content-Type': 'application/javascript' })
+    return _compiled_response(compiled, 'application/javascript')
 
 # Render LESS files on-demand
 @static.route('/less/<string:filename>')
@@ -27,9 +144,16 @@ def _less(filename):
     if not os.path.exists('less/%s' % filename):
         abort(404)
 
-    r = subprocess.check_output(["node_modules/less/bin/lessc", "less/%s" % filename])
+    # Files in `less/` may import each other, so any change recompiles,
+    # as does a change to anything imported from outside `less/`
+    compiled = _compile(
+        filename,
+        'less',
+        ["node_modules/less/bin/lessc", "less/%s" % filename],
+        ["node_modules/less/bin/lessc", "--depends", "less/%s" % filename, os.devnull]
+    )
 
-    return make_response(r, 200, { 'Content-Type': 'text/css' })
+    return _compiled_response(compiled, 'text/css')
 
 # Render application configuration
 @static.route('/js/app_config.js')
@@ -42,9 +166,11 @@ def _app_config_js():
 # Render copytext
 @static.route('/js/copy.js')
 def _copy_js():
-    copy = 'window.COPY = ' + copytext.Copy(app_config.COPY_PATH).json()
+    copy = load_copy(app_config.COPY_PATH)
+    mtime, size = copy.version
+    etag = '{0:x}-{1:x}'.format(mtime, size)
 
-    return make_response(copy, 200, { 'Content-Type': 'application/javascript' })
+    return _compiled_response((etag, mtime / 1e9, copy.js()), 'application/javascript')
 
 # Server arbitrary static files on-demand
 @static.route('/<path:path>')
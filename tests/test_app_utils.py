@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import threading
+import time
+import unittest
+
+from collections import OrderedDict
+
+from app_utils import LocalStore, ResultsCache
+
+
+class StubResults(object):
+    """
+    Stands in for `get_results`, counting its calls. `races` can be
+    changed between fetches, and `during_fetch` is called mid-fetch.
+    """
+    def __init__(self):
+        self.races = OrderedDict([
+            ('1001', [{'last': 'Smith', 'votecount': 10}]),
+            ('1002', [{'last': 'Jones', 'votecount': 20}])
+        ])
+        self.calls = 0
+        self.during_fetch = None
+        self.error = None
+
+    def __call__(self, name):
+        self.calls += 1
+        if self.during_fetch:
+            self.during_fetch()
+        if self.error:
+            raise self.error
+        return OrderedDict(
+            (raceid, [dict(result) for result in race]) for raceid, race in self.races.items()
+        )
+
+
+class ResultsCacheTestCase(unittest.TestCase):
+    """
+    Test the calls page's shared results cache
+    """
+    def setUp(self):
+        self.fetch = StubResults()
+        self.store = LocalStore()
+
+    def _cache(self, ttl=60, store=None):
+        return ResultsCache(ttl, store=store or self.store, fetch=self.fetch)
+
+    def test_results_are_cached(self):
+        cache = self._cache()
+        first = cache.get('U.S. Senate')
+        second = cache.get('U.S. Senate')
+
+        self.assertEqual(list(first), ['1001', '1002'])
+        self.assertIs(second, first)
+        self.assertEqual(self.fetch.calls, 1)
+
+    def test_workers_share_a_store(self):
+        self._cache().get('U.S. Senate')
+        other_worker = self._cache()
+
+        self.assertEqual(list(other_worker.get('U.S. Senate')), ['1001', '1002'])
+        self.assertEqual(self.fetch.calls, 1)
+
+    def test_token_parsing(self):
+        cache = self._cache()
+        token = cache.get_versioned('U.S. Senate')[1]
+        epoch, version = token.split('-')
+
+        self.assertEqual(epoch, cache.epoch)
+        self.assertEqual(cache._parse_token(token), int(version))
+        self.assertIsNone(cache._parse_token(None))
+        self.assertIsNone(cache._parse_token('nonsense'))
+        self.assertIsNone(cache._parse_token('{0}-nonsense'.format(epoch)))
+
+    def test_tokens_from_another_epoch(self):
+        token = self._cache().get_versioned('U.S. Senate')[1]
+
+        # eg after the app restarts
+        store = LocalStore()
+        store.set('epoch', 'restarted')
+        cache = self._cache(store=store)
+
+        self.assertIsNone(cache._parse_token(token))
+        new_token, results, changed = cache.changes('U.S. Senate', since=token)
+        self.assertTrue(new_token.startswith('restarted-'))
+        self.assertEqual(changed, ['1001', '1002'])
+
+    def test_all_races_changed_without_token(self):
+        token, results, changed = self._cache().changes('U.S. Senate')
+        self.assertEqual(changed, ['1001', '1002'])
+
+    def test_changed_races(self):
+        cache = self._cache(ttl=0)
+        token, results, changed = cache.changes('U.S. Senate')
+
+        self.fetch.races['1002'][0]['votecount'] = 25
+        new_token, results, changed = cache.changes('U.S. Senate', since=token)
+
+        self.assertNotEqual(new_token, token)
+        self.assertEqual(changed, ['1002'])
+        self.assertEqual(results['1002'][0]['votecount'], 25)
+
+        # Nothing changed since the new token, so it stays the same
+        newest_token, results, changed = cache.changes('U.S. Senate', since=new_token)
+        self.assertEqual(newest_token, new_token)
+        self.assertEqual(changed, [])
+
+        # Changes since the first token are still reported
+        self.assertEqual(cache.changes('U.S. Senate', since=token)[2], ['1002'])
+
+    def test_new_races_are_changed(self):
+        cache = self._cache(ttl=0)
+        token = cache.get_versioned('U.S. Senate')[1]
+
+        self.fetch.races['1003'] = [{'last': 'Brown', 'votecount': 5}]
+        self.assertEqual(cache.changes('U.S. Senate', since=token)[2], ['1003'])
+
+    def test_invalidate(self):
+        cache = self._cache()
+        cache.get('U.S. Senate')
+        cache.invalidate('U.S. Senate')
+        cache.get('U.S. Senate')
+
+        self.assertEqual(self.fetch.calls, 2)
+
+    def test_invalidate_every_office(self):
+        cache = self._cache()
+        cache.get('U.S. Senate')
+        cache.get('U.S. House')
+        cache.invalidate()
+        cache.get('U.S. Senate')
+        cache.get('U.S. House')
+
+        self.assertEqual(self.fetch.calls, 4)
+
+    def test_invalidated_during_fetch(self):
+        cache = self._cache()
+        self.fetch.during_fetch = lambda: cache.invalidate('U.S. Senate')
+        cache.get('U.S. Senate')
+
+        # The results fetched may have missed the change, so they aren't
+        # reused
+        self.fetch.during_fetch = None
+        cache.get('U.S. Senate')
+        cache.get('U.S. Senate')
+        self.assertEqual(self.fetch.calls, 2)
+
+    def test_stale_results_while_another_worker_refetches(self):
+        cache = self._cache(ttl=0)
+        first = cache.get('U.S. Senate')
+
+        key = cache._key('U.S. Senate')
+        office = self.store.get(key)
+        office['claimed'] = time.time()
+        self.store.set(key, office)
+
+        self.assertIs(cache.get('U.S. Senate'), first)
+        self.assertEqual(self.fetch.calls, 1)
+
+    def test_readers_wait_for_refetch_after_invalidate(self):
+        cache = self._cache()
+        token = cache.get_versioned('U.S. Senate')[1]
+
+        fetching = threading.Event()
+        finish = threading.Event()
+
+        def slow_fetch():
+            fetching.set()
+            finish.wait(5)
+
+        self.fetch.races['1002'][0]['votecount'] = 25
+        self.fetch.during_fetch = slow_fetch
+        cache.invalidate('U.S. Senate')
+
+        changes = []
+
+        def read():
+            changes.append(self._cache().changes('U.S. Senate', since=token))
+
+        claimer = threading.Thread(target=read)
+        claimer.start()
+        self.assertTrue(fetching.wait(5))
+        readers = [threading.Thread(target=read) for i in range(4)]
+        for reader in readers:
+            reader.start()
+        time.sleep(0.2)
+        # Nobody got the results from before the call
+        self.assertEqual(changes, [])
+
+        finish.set()
+        for thread in [claimer] + readers:
+            thread.join(5)
+
+        self.assertEqual(self.fetch.calls, 2)
+        self.assertEqual(len(changes), 5)
+        for new_token, results, changed in changes:
+            self.assertNotEqual(new_token, token)
+            self.assertEqual(changed, ['1002'])
+
+    def test_readers_take_over_abandoned_refetch(self):
+        cache = self._cache()
+        cache.get('U.S. Senate')
+        cache.invalidate('U.S. Senate')
+
+        key = cache._key('U.S. Senate')
+        office = self.store.get(key)
+        office['claimed'] = time.time() - cache.refresh_timeout + 0.2
+        self.store.set(key, office)
+
+        cache.get('U.S. Senate')
+        self.assertEqual(self.fetch.calls, 2)
+
+    def test_failed_fetch_releases_claim(self):
+        cache = self._cache()
+        self.fetch.error = ValueError('database went away')
+        with self.assertRaises(ValueError):
+            cache.get('U.S. Senate')
+
+        self.fetch.error = None
+        self.assertEqual(list(cache.get('U.S. Senate')), ['1001', '1002'])
+        self.assertEqual(self.fetch.calls, 2)
+
+    def test_empty_results_are_not_kept(self):
+        cache = self._cache()
+        self.fetch.races = OrderedDict()
+        self.assertEqual(cache.get('U.S. Senate'), OrderedDict())
+        cache.get('U.S. Senate')
+
+        self.assertEqual(self.fetch.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from fabfile.census import CensusFetcher, TokenBucket
+
+
+class StubCensusReporter(BaseHTTPRequestHandler):
+    """
+    Answers like Census Reporter's data API: a 400 for a batch with an
+    unknown geography in it, and a 429 for the first `rate_limited`
+    requests.
+    """
+    requests = []
+    rate_limited = 0
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        geo_ids = params['geo_ids'][0].split(',')
+        tables = params['table_ids'][0].split(',')
+        self.requests.append(geo_ids)
+
+        if len(self.requests) <= self.rate_limited:
+            self._respond(429, {'error': 'slow down'}, {'Retry-After': '0'})
+        elif any(geo_id.startswith('bad') for geo_id in geo_ids):
+            self._respond(400, {'error': 'unknown geography'})
+        else:
+            self._respond(200, {
+                'tables': {table: {} for table in tables},
+                'geography': {geo_id: {'name': geo_id} for geo_id in geo_ids},
+                'data': {geo_id: {table: {'estimate': {}} for table in tables} for geo_id in geo_ids}
+            })
+
+    def _respond(self, status, body, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CensusFetcherTestCase(unittest.TestCase):
+    """
+    Test fetching census data from a local stub of Census Reporter
+    """
+    def setUp(self):
+        StubCensusReporter.requests = []
+        StubCensusReporter.rate_limited = 0
+        self.server = HTTPServer(('127.0.0.1', 0), StubCensusReporter)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.cache_path)
+
+    def _fetcher(self, **kwargs):
+        return CensusFetcher(
+            ['B01003'],
+            base_url='http://127.0.0.1:{0}/'.format(self.server.server_port),
+            cache_path=self.cache_path,
+            batch_size=4,
+            workers=1,
+            requests_per_second=1000,
+            **kwargs
+        )
+
+    def test_batches(self):
+        geo_ids = ['05000US0100{0}'.format(i) for i in range(8)]
+        responses = self._fetcher().fetch(geo_ids)
+
+        self.assertEqual(sorted(responses), geo_ids)
+        self.assertEqual(len(StubCensusReporter.requests), 2)
+        self.assertEqual(responses[geo_ids[0]]['data'], {geo_ids[0]: {'B01003': {'estimate': {}}}})
+
+    def test_rate_limited_batch_is_retried(self):
+        StubCensusReporter.rate_limited = 2
+        geo_ids = ['05000US0100{0}'.format(i) for i in range(4)]
+        responses = self._fetcher().fetch(geo_ids)
+
+        self.assertEqual(sorted(responses), geo_ids)
+        # Retried whole, rather than split up
+        self.assertEqual(StubCensusReporter.requests, [geo_ids] * 3)
+
+    def test_rate_limited_too_often(self):
+        StubCensusReporter.rate_limited = 10
+        responses = self._fetcher(retries=1).fetch(['05000US01001'])
+
+        self.assertEqual(responses, {})
+        self.assertEqual(len(StubCensusReporter.requests), 2)
+
+    def test_bad_geography_in_batch(self):
+        geo_ids = ['05000US01001', '05000US01003', 'bad', '05000US01005']
+        responses = self._fetcher().fetch(geo_ids)
+
+        self.assertEqual(sorted(responses), ['05000US01001', '05000US01003', '05000US01005'])
+        self.assertIn(['bad'], StubCensusReporter.requests)
+
+    def test_cached_geographies_are_not_fetched_again(self):
+        geo_ids = ['05000US01001', '05000US01003']
+        self._fetcher().fetch(geo_ids)
+        responses = self._fetcher().fetch(geo_ids)
+
+        self.assertEqual(sorted(responses), geo_ids)
+        self.assertEqual(len(StubCensusReporter.requests), 1)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Test the rate limit shared by census requests
+    """
+    def test_burst(self):
+        bucket = TokenBucket(rate=1, capacity=3)
+
+        start = time.time()
+        for i in range(3):
+            bucket.acquire()
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_waits_for_a_token(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        bucket.acquire()
+
+        start = time.time()
+        bucket.acquire()
+        bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.09)
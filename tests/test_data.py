@@ -3,6 +3,11 @@
 import app_config
 import app_utils
 import calendar
+import json
+import os
+import shutil
+import sys
+import tempfile
 import time
 import unittest
 
@@ -109,5 +114,253 @@ class ResultsRenderingTestCase(unittest.TestCase):
         self.assertEqual(len(serialized_results.keys()), 67)
 
 
+class CensusExtractionTestCase(unittest.TestCase):
+    """
+    Test extracting county figures from Census Reporter responses
+    """
+    def setUp(self):
+        with open('tests/data/census.json') as f:
+            fixture = json.load(f)
+        self.census = fixture['census']
+        # What the per-county extraction this replaced gave for the
+        # same responses
+        self.expected = fixture['expected']
+
+    def test_matches_previous_output(self):
+        self.assertEqual(data.extract_census_batch(self.census), self.expected)
+
+    def test_counties_without_data(self):
+        self.census['23009'] = None
+        self.census['23011'] = {'data': {}}
+        extracted = data.extract_census_batch(self.census)
+
+        self.assertEqual(sorted(extracted), sorted(self.expected))
+        self.assertEqual(data.extract_census_batch({}), {})
+
+    def test_zero_totals(self):
+        county = next(iter(self.census['23001']['data'].values()))
+        county['B15001']['estimate']['B15001001'] = 0
+        county['B02001']['estimate']['B02001001'] = 0
+        extracted = data.extract_census_batch(self.census)['23001']
+
+        self.assertIsNone(extracted['percent_bachelors'])
+        self.assertIsNone(extracted['error'])
+        self.assertIsNone(extracted['percent_black'])
+        self.assertEqual(extracted['percent_white'], self.expected['23001']['percent_white'])
+
+
+class PartyOverridesTestCase(unittest.TestCase):
+    """
+    Test the statement that applies `PARTY_OVERRIDES`
+    """
+    def setUp(self):
+        self.party_overrides = app_config.PARTY_OVERRIDES
+
+    def tearDown(self):
+        app_config.PARTY_OVERRIDES = self.party_overrides
+
+    def test_single_update(self):
+        app_config.PARTY_OVERRIDES = {
+            'Dem': ['67552', '1001'],
+            'GOP': ['2002']
+        }
+        self.assertEqual(data._party_overrides_sql('result_new'), (
+            'UPDATE result_new SET party = overrides.party '
+            'FROM (VALUES (\'67552\', \'Dem\'), (\'1001\', \'Dem\'), (\'2002\', \'GOP\')) '
+            'AS overrides (polid, party) '
+            'WHERE result_new.polid = overrides.polid;'
+        ))
+
+    def test_quotes_are_escaped(self):
+        app_config.PARTY_OVERRIDES = {"O'Party": ["1'2"]}
+        self.assertIn("('1''2', 'O''Party')", data._party_overrides_sql())
+
+    def test_no_overrides(self):
+        app_config.PARTY_OVERRIDES = {}
+        self.assertIsNone(data._party_overrides_sql())
+        app_config.PARTY_OVERRIDES = {'Dem': []}
+        self.assertIsNone(data._party_overrides_sql())
+
+
+class CSVIndexTestCase(unittest.TestCase):
+    """
+    Test the CSV lookups used by `save_old_data`
+    """
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as f:
+            f.write('fipscode,last,level,votepct\n')
+            f.write('12001,Clinton,county,0.614\n')
+            f.write('12001,Trump,county,0.358\n')
+            f.write('12001,Trump,township,0.9\n')
+            f.write('12001,Trump,county,0.5\n')
+            f.write('12003,Trump,county,0.819\n')
+
+    def tearDown(self):
+        data._csv_indexes.pop(self.filename, None)
+        os.remove(self.filename)
+
+    def test_first_duplicate_is_kept(self):
+        self.assertEqual(data._load_margin_index(self.filename), {
+            ('12001', 'Clinton'): '0.614',
+            ('12001', 'Trump'): '0.358',
+            ('12003', 'Trump'): '0.819'
+        })
+
+    def test_file_is_read_once(self):
+        index = data._load_margin_index(self.filename)
+        with open(self.filename, 'a') as f:
+            f.write('12005,Trump,county,0.705\n')
+
+        self.assertIs(data._load_margin_index(self.filename), index)
+        self.assertNotIn(('12005', 'Trump'), index)
+
+    def test_margin_lookup(self):
+        self.assertEqual(data.extract_margin_data('12001', self.filename), 'D +26')
+        # Only one of the candidates
+        self.assertIsNone(data.extract_margin_data('12003', self.filename))
+
+
+
+# Stands in for `elex results`, doing what its flags ask
+STUB_ELEX = """#!{python}
+import csv
+import os
+import sys
+import time
+
+folder = os.environ['STUB_ELEX_FOLDER']
+flag, value = (sys.argv[2:] + [None, None])[:2]
+with open(os.path.join(folder, 'calls'), 'a') as f:
+    f.write(' '.join(sys.argv[2:-1]) + '\\n')
+
+if flag == '--hang':
+    with open(os.path.join(folder, 'hung.pid'), 'w') as f:
+        f.write(str(os.getpid()))
+    time.sleep(60)
+elif flag == '--fail':
+    sys.stderr.write('AP API is down\\n')
+    sys.exit(1)
+elif flag == '--partial':
+    sys.stdout.write('id,raceid,racetype\\n0-polid')
+    sys.exit(1)
+elif flag == '--flaky' and not os.path.exists(os.path.join(folder, 'flaked')):
+    open(os.path.join(folder, 'flaked'), 'w').close()
+    sys.exit(1)
+
+with open(os.environ['STUB_ELEX_RESULTS']) as f:
+    reader = csv.DictReader(f)
+    writer = csv.DictWriter(sys.stdout, reader.fieldnames)
+    writer.writeheader()
+    for row in reader:
+        row['id'] = '{{0}}-{{1}}'.format(value, row['id'])
+        writer.writerow(row)
+"""
+
+
+class ElexFetchTestCase(unittest.TestCase):
+    """
+    Test fetching results from a stub `elex` that hangs, fails or
+    returns results on request
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        elex = os.path.join(self.folder, 'elex')
+        with open(elex, 'w') as f:
+            f.write(STUB_ELEX.format(python=sys.executable))
+        os.chmod(elex, 0o755)
+
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = self.folder + os.pathsep + os.environ['PATH']
+        os.environ['STUB_ELEX_FOLDER'] = self.folder
+        os.environ['STUB_ELEX_RESULTS'] = os.path.abspath('tests/data/results.csv')
+
+        self.settings = (
+            app_config.ELEX_FETCH_TIMEOUT,
+            app_config.ELEX_FETCH_ATTEMPTS,
+            app_config.ELEX_OUTPUT_FOLDER
+        )
+        app_config.ELEX_FETCH_TIMEOUT = 10
+        app_config.ELEX_FETCH_ATTEMPTS = 2
+        app_config.ELEX_OUTPUT_FOLDER = os.path.join(self.folder, 'output')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        (
+            app_config.ELEX_FETCH_TIMEOUT,
+            app_config.ELEX_FETCH_ATTEMPTS,
+            app_config.ELEX_OUTPUT_FOLDER
+        ) = self.settings
+        shutil.rmtree(self.folder)
+
+    def _filenames(self, flag_sets):
+        return [
+            os.path.join(self.folder, 'results-{0}.csv'.format(i))
+            for i in range(len(flag_sets))
+        ]
+
+    def _calls(self):
+        with open(os.path.join(self.folder, 'calls')) as f:
+            return f.read().splitlines()
+
+    def test_hung_flag_set_is_killed_at_deadline(self):
+        app_config.ELEX_FETCH_TIMEOUT = 1
+        flag_sets = ['--officeids S', '--hang']
+        filenames = self._filenames(flag_sets)
+
+        start = time.time()
+        errors = data.fetch_results(flag_sets, filenames)
+
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(errors, [('--hang', 'timed out')])
+        self.assertTrue(os.path.exists(filenames[0]))
+
+        with open(os.path.join(self.folder, 'hung.pid')) as f:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(int(f.read()), 0)
+
+    def test_failure_keeps_other_output(self):
+        flag_sets = ['--officeids S', '--fail', '--partial']
+        filenames = self._filenames(flag_sets)
+        for filename in filenames[1:]:
+            with open(filename, 'w') as f:
+                f.write('last good results')
+
+        errors = data.fetch_results(flag_sets, filenames)
+
+        self.assertEqual(errors, [('--fail', 'AP API is down'), ('--partial', 'exit code 1')])
+        with open(filenames[0]) as f:
+            self.assertEqual(len(f.read().splitlines()), 5)
+        # A failed fetch never replaces the last good one
+        for filename in filenames[1:]:
+            with open(filename) as f:
+                self.assertEqual(f.read(), 'last good results')
+            self.assertFalse(os.path.exists('{0}.tmp'.format(filename)))
+
+    def test_failed_attempt_is_retried(self):
+        flag_sets = ['--flaky x']
+        self.assertEqual(data.fetch_results(flag_sets, self._filenames(flag_sets)), [])
+        self.assertEqual(self._calls(), ['--flaky x', '--flaky x'])
+
+    def test_results_are_copied_once_each(self):
+        flag_sets = ['--officeids S', '--officeids G']
+        filenames = self._filenames(flag_sets)
+        self.assertEqual(data.fetch_results(flag_sets, filenames), [])
+
+        # Each file's header is skipped, rather than copied as a result
+        self.assertEqual(data.copy_results(filenames), [(filenames[0], 4), (filenames[1], 4)])
+        count = 'SELECT count(*) FROM {0};'.format(data.SHADOW_RESULTS_TABLE)
+        self.assertEqual(models.db.execute_sql(count).fetchone()[0], 8)
+
+    def test_flag_sets_from_command_line(self):
+        app_config.ELEX_FETCH_ATTEMPTS = 1
+        self.assertFalse(data.load_results(flag_sets='--officeids S ; --fail'))
+        self.assertEqual(sorted(self._calls()), ['--fail', '--officeids S'])
+
+        with self.assertRaises(ValueError):
+            data.load_results(flag_sets=' ; ')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import app_config
+import json
+import metrics
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class RegistryTestCase(unittest.TestCase):
+    """
+    Test recording, merging and formatting metrics
+    """
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counters_and_gauges(self):
+        self.registry.increment('queries')
+        self.registry.increment('queries', 2)
+        self.registry.increment('responses', status=200)
+        self.registry.set_gauge('rows', 10)
+        self.registry.set_gauge('rows', 12)
+
+        dumped = self.registry.dump()
+        self.assertEqual(sorted(dumped['counters']), [
+            ['queries', {}, 3],
+            ['responses', {'status': 200}, 1]
+        ])
+        self.assertEqual(dumped['gauges'], [['rows', {}, 12]])
+
+    def test_timers(self):
+        self.registry.observe('stage', 2.0, stage='copy')
+        self.registry.observe('stage', 1.0, stage='copy')
+
+        @self.registry.timed('render')
+        def render_senate():
+            return 'rendered'
+
+        self.assertEqual(render_senate(), 'rendered')
+
+        timers = {
+            labels.get('stage', labels.get('task')): timer
+            for name, labels, timer in self.registry.dump()['timers']
+        }
+        self.assertEqual(timers['copy'], {'count': 2, 'sum': 3.0, 'max': 2.0, 'last': 1.0})
+        self.assertEqual(timers['render_senate']['count'], 1)
+
+    def test_merge(self):
+        self.registry.increment('queries', 2)
+        self.registry.observe('stage', 2.0, stage='copy')
+
+        other = metrics.Registry()
+        other.increment('queries', 3)
+        other.observe('stage', 4.0, stage='copy')
+        self.registry.merge(other.dump())
+
+        dumped = self.registry.dump()
+        self.assertEqual(dumped['counters'], [['queries', {}, 5]])
+        self.assertEqual(dumped['timers'][0][2], {'count': 2, 'sum': 6.0, 'max': 4.0, 'last': 4.0})
+
+    def test_to_prometheus(self):
+        self.registry.increment('responses', status=200)
+        self.registry.set_gauge('rows', 12)
+        self.registry.observe('stage', 1.5, stage='copy')
+
+        prefix = metrics.METRIC_PREFIX
+        lines = metrics.to_prometheus(self.registry.dump(), process='daemon').splitlines()
+        self.assertEqual(lines, [
+            '{0}_responses_total{{process="daemon",status="200"}} 1'.format(prefix),
+            '{0}_rows{{process="daemon"}} 12'.format(prefix),
+            '{0}_stage_seconds_count{{process="daemon",stage="copy"}} 1'.format(prefix),
+            '{0}_stage_seconds_sum{{process="daemon",stage="copy"}} 1.5'.format(prefix),
+            '{0}_stage_seconds_max{{process="daemon",stage="copy"}} 1.5'.format(prefix),
+            '{0}_stage_seconds_last{{process="daemon",stage="copy"}} 1.5'.format(prefix)
+        ])
+
+    def test_label_escaping(self):
+        self.assertEqual(metrics._format_labels({'path': 'a"b\\c'}), '{path="a\\"b\\\\c"}')
+        self.assertEqual(metrics._format_labels({}), '')
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Test the snapshots shared between the daemon, app workers and the
+    metrics endpoint
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'daemon-metrics.json')
+        self.metrics_path = app_config.METRICS_PATH
+        app_config.METRICS_PATH = self.path
+        metrics.registry.reset()
+        metrics.totals.reset()
+
+    def tearDown(self):
+        app_config.METRICS_PATH = self.metrics_path
+        metrics.registry.reset()
+        metrics.totals.reset()
+        shutil.rmtree(self.folder)
+
+    def test_end_cycle(self):
+        metrics.increment('queries', 4)
+        metrics.observe('stage', 1.25, stage='copy')
+        summary = metrics.end_cycle(cycle_seconds=2.5)
+
+        self.assertEqual(summary['stages'], {'stage.copy': 1.25})
+        self.assertEqual(summary['counters'], {'queries': 4})
+        self.assertEqual(summary['cycle_seconds'], 2.5)
+        self.assertEqual(metrics.registry.dump()['counters'], [])
+
+        metrics.increment('queries', 1)
+        metrics.end_cycle()
+
+        snapshot = metrics.load_snapshot()
+        self.assertEqual(snapshot['counters'], [['queries', {}, 5]])
+        self.assertEqual(snapshot['last_cycle']['counters'], {'queries': 1})
+        json.dumps(snapshot)
+
+    def test_missing_snapshot(self):
+        self.assertIsNone(metrics.load_snapshot())
+
+    def test_workers(self):
+        metrics.save_snapshot({
+            'counters': [['responses', {'status': 200}, 3]],
+            'gauges': [['db_pool_in_use', {}, 2]],
+            'timers': [
+                ['request', {'endpoint': 'calls_admin'}, {'count': 3, 'sum': 0.3, 'max': 0.2, 'last': 0.1}]
+            ]
+        }, os.path.join(metrics._workers_folder(), '100.json'))
+
+        metrics.increment('responses', 2, status=200)
+        metrics.set_gauge('db_pool_in_use', 1)
+        metrics.save_worker_snapshot(force=True)
+
+        snapshots = metrics.load_worker_snapshots()
+        self.assertEqual(sorted(snapshots), sorted(['100', str(os.getpid())]))
+
+        merged = metrics.merge_workers(snapshots)
+        self.assertEqual(merged['counters'], [['responses', {'status': 200}, 5]])
+        self.assertEqual(sorted(merged['gauges'], key=lambda gauge: gauge[1]['worker']), sorted([
+            ['db_pool_in_use', {'worker': '100'}, 2],
+            ['db_pool_in_use', {'worker': str(os.getpid())}, 1]
+        ], key=lambda gauge: gauge[1]['worker']))
+        self.assertEqual(merged['timers'][0][2]['count'], 3)
+
+        metrics.clear_worker_snapshots()
+        self.assertEqual(metrics.load_worker_snapshots(), {})
+
+    def test_worker_saves_are_throttled(self):
+        metrics.save_worker_snapshot(force=True)
+        metrics.increment('responses', status=200)
+        metrics.save_worker_snapshot()
+
+        snapshot = metrics.load_worker_snapshots()[str(os.getpid())]
+        self.assertEqual(snapshot['counters'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import unittest
+
+from models.profiler import QueryProfiler
+
+
+class QueryProfilerTestCase(unittest.TestCase):
+    """
+    Test counting queries by caller and keeping the slowest
+    """
+    def setUp(self):
+        self.profiler = QueryProfiler(enabled=True, slowest_count=2)
+
+    def test_counts_by_caller(self):
+        self.profiler.record('SELECT 1', [], 0.5)
+        self.profiler.record('SELECT 2', [], 0.25)
+
+        self.assertEqual(self.profiler.dump()['by_caller'], {
+            'tests/test_profiler.py:test_counts_by_caller': (2, 0.75)
+        })
+
+    def test_keeps_slowest(self):
+        for seconds in (0.1, 0.4, 0.2, 0.3):
+            self.profiler.record('SELECT {0}'.format(seconds), [], seconds)
+
+        slowest = sorted(entry[0] for entry in self.profiler.dump()['slowest'])
+        self.assertEqual(slowest, [0.3, 0.4])
+
+    def test_merge(self):
+        self.profiler.record('SELECT 1', [], 0.1)
+
+        worker = QueryProfiler(enabled=True, slowest_count=2)
+        worker.record('SELECT 2', [], 0.5)
+        worker.record('SELECT 3', [], 0.3)
+        self.profiler.merge(worker.dump())
+
+        dumped = self.profiler.dump()
+        self.assertEqual(dumped['by_caller'], {'tests/test_profiler.py:test_merge': (3, 0.9)})
+        self.assertEqual(sorted(entry[3] for entry in dumped['slowest']), ['SELECT 2', 'SELECT 3'])
+
+    def test_report(self):
+        self.profiler.record('SELECT 1', [1], 0.5)
+        self.profiler.record('UPDATE result SET party = %s', ['Dem'], 0.25)
+        report = self.profiler.report(None, explain=False)
+
+        self.assertIn('SQL profile: 2 queries, 0.750s', report)
+        self.assertIn('tests/test_profiler.py:test_report', report)
+        self.assertLess(report.index('SELECT 1'), report.index('UPDATE result'))
+        self.assertEqual(self.profiler.dump()['by_caller'], {})
+
+    def test_failed_explain(self):
+        class BrokenDatabase(object):
+            def execute_sql(self, sql, params):
+                raise ValueError('no database')
+
+        self.profiler.record('SELECT 1', [], 0.5)
+        report = self.profiler.report(BrokenDatabase())
+
+        self.assertIn('EXPLAIN failed: no database', report)
+        self.assertTrue(self.profiler.enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import app_config
+import os
+import shutil
+import static
+import sys
+import tempfile
+import unittest
+
+from flask import Flask
+
+# Stands in for `lessc`: compiles a file to itself plus whatever it
+# imports, where `@import` lines name files relative to the project
+STUB_LESSC = """#!{python}
+import sys
+
+def imports(path):
+    with open(path) as f:
+        return [line.split()[1] for line in f if line.startswith('@import')]
+
+if sys.argv[1] == '--depends':
+    print('{{0}}: {{1}}'.format(sys.argv[3], ' '.join(imports(sys.argv[2]))))
+else:
+    with open('compiles.log', 'a') as log:
+        log.write(sys.argv[1] + '\\n')
+    for path in [sys.argv[1]] + imports(sys.argv[1]):
+        with open(path) as f:
+            sys.stdout.write(f.read())
+"""
+
+
+class CompiledLESSTestCase(unittest.TestCase):
+    """
+    Test recompiling LESS only when it or anything it imports changes
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+
+        os.makedirs('node_modules/less/bin')
+        with open('node_modules/less/bin/lessc', 'w') as f:
+            f.write(STUB_LESSC.format(python=sys.executable))
+        os.chmod('node_modules/less/bin/lessc', 0o755)
+
+        os.makedirs('less')
+        os.makedirs('shared')
+        self._write('shared/colors.less', '@dem: blue;\n')
+        self._write('less/app.less', '@import shared/colors.less\n.race {}\n')
+
+        self.cache_folder = app_config.STATIC_CACHE_FOLDER
+        app_config.STATIC_CACHE_FOLDER = os.path.join(self.folder, 'cache')
+        static._compiled.clear()
+
+        app = Flask(__name__)
+        app.register_blueprint(static.static)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        app_config.STATIC_CACHE_FOLDER = self.cache_folder
+        static._compiled.clear()
+        shutil.rmtree(self.folder)
+
+    def _write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def _compiles(self):
+        try:
+            with open('compiles.log') as f:
+                return len(f.read().splitlines())
+        except IOError:
+            return 0
+
+    def test_compiled_once(self):
+        first = self.client.get('/less/app.less')
+        second = self.client.get('/less/app.less')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertIn(b'@dem: blue;', first.data)
+        self.assertEqual(second.get_etag(), first.get_etag())
+        self.assertEqual(self._compiles(), 1)
+
+    def test_imported_file_changes(self):
+        etag = self.client.get('/less/app.less').get_etag()[0]
+        self._write('shared/colors.less', '@dem: darkblue;\n')
+        response = self.client.get('/less/app.less')
+
+        self.assertNotEqual(response.get_etag()[0], etag)
+        self.assertIn(b'@dem: darkblue;', response.data)
+        self.assertEqual(self._compiles(), 2)
+
+    def test_other_processes_reuse_output(self):
+        self.client.get('/less/app.less')
+        static._compiled.clear()
+        self.client.get('/less/app.less')
+
+        self.assertEqual(self._compiles(), 1)
+
+    def test_missing_dependencies(self):
+        self.client.get('/less/app.less')
+        static._compiled.clear()
+        os.remove(static._dependencies_path('app.less'))
+
+        # Without its imports the fingerprint doesn't match, so it's
+        # compiled again, and its imports recorded again
+        self.client.get('/less/app.less')
+        self.assertEqual(self._compiles(), 2)
+        self.assertEqual(static._load_dependencies('app.less'), ['shared/colors.less'])
+
+    def test_corrupt_dependencies(self):
+        self.client.get('/less/app.less')
+        static._compiled.clear()
+        self._write(static._dependencies_path('app.less'), '["shared/col')
+
+        response = self.client.get('/less/app.less')
+        self.assertIn(b'@dem: blue;', response.data)
+        self.assertEqual(self._compiles(), 2)
+        self.assertEqual(static._load_dependencies('app.less'), ['shared/colors.less'])
+
+    def test_not_modified(self):
+        etag = self.client.get('/less/app.less').get_etag()[0]
+        headers = {'If-None-Match': '"{0}"'.format(etag)}
+        response = self.client.get('/less/app.less', headers=headers)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_missing_file(self):
+        self.assertEqual(self.client.get('/less/missing.less').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
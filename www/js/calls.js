@@ -1,9 +1,6 @@
-var $acceptAP;
-var $rejectAP;
-var $callNPR;
-var $uncallNPR;
 var $overlay;
 var $body;
+var $container;
 var $allowChamberCall;
 var $callChamberDem;
 var $callChamberGOP;
@@ -12,21 +9,74 @@ var $uncallChamber;
 var ACCEPT_AP_URL = document.location.href + 'accept-ap';
 var CALL_NPR_URL = document.location.href + 'call-npr';
 var CHAMBER_CALL_URL = document.location.href + 'call-chamber';
-
-var pageRefresh = null;
+var CHANGES_URL = document.location.href + 'changes';
+var EVENTS_URL = document.location.href + 'events';
+
+var REFRESH_INTERVAL = 10000;
+// While the events stream is open, only poll as a fallback
+var EVENTS_REFRESH_INTERVAL = 60000;
+// Wait briefly after an event, so a burst of them only fetches once
+var EVENT_REFRESH_DELAY = 250;
+// Look once more this long after a call's event, if it changed nothing
+var CALL_EVENT_RETRY_DELAY = 1000;
+
+var version = null;
+var chamberCallOverride = null;
+var refreshTimer = null;
+var eventRefreshTimer = null;
+var pendingCall = false;
 
 var onDocumentLoad = function() {
-    $acceptAP = $('.accept-ap');
-    $rejectAP = $('.reject-ap')
-    $callNPR = $('.npr-call');
-    $uncallNPR = $('.npr-uncall');
     $overlay = $('.overlay');
     $body = $('body');
 
-    $acceptAP.on('click', onAPClick);
-    $rejectAP.on('click', onAPClick);
-    $callNPR.on('click', onCallNPRClick);
-    $uncallNPR.on('click', onUncallNPRClick);
+    // Race markup is swapped out as it changes, so listen for clicks
+    // on the page rather than on each button
+    $body.on('click', '.accept-ap, .reject-ap', onAPClick);
+    $body.on('click', '.npr-call', onCallNPRClick);
+    $body.on('click', '.npr-uncall', onUncallNPRClick);
+
+    bindContainer();
+
+    pollEvery(REFRESH_INTERVAL);
+    listenForEvents();
+}
+
+var pollEvery = function(interval) {
+    clearInterval(refreshTimer);
+    refreshTimer = setInterval(function() { refreshRaces(); }, interval);
+}
+
+var listenForEvents = function() {
+    if (!window.EventSource) {
+        return;
+    }
+
+    // The server closes the stream periodically, and `EventSource`
+    // reconnects on its own
+    var source = new EventSource(EVENTS_URL);
+    source.addEventListener('open', function() { pollEvery(EVENTS_REFRESH_INTERVAL); });
+    source.addEventListener('error', function() { pollEvery(REFRESH_INTERVAL); });
+    source.addEventListener('results', onChangeEvent);
+    source.addEventListener('calls', onChangeEvent);
+}
+
+var onChangeEvent = function(e) {
+    pendingCall = pendingCall || e.type === 'calls';
+
+    clearTimeout(eventRefreshTimer);
+    eventRefreshTimer = setTimeout(function() {
+        var retryIfUnchanged = pendingCall;
+        pendingCall = false;
+        refreshRaces(retryIfUnchanged);
+    }, EVENT_REFRESH_DELAY);
+}
+
+var bindContainer = function() {
+    $container = $('.container');
+
+    version = $container.data('version');
+    chamberCallOverride = $container.data('chamber-call-override') || null;
 
     $allowChamberCall = $('#allow-chamber-call');
     $callChamberDem = $('#call-chamber-dem');
@@ -36,14 +86,11 @@ var onDocumentLoad = function() {
     if ($callChamberDem) { $callChamberDem.on('click', onCallChamberDem); }
     if ($callChamberGOP) { $callChamberGOP.on('click', onCallChamberGOP); }
     if ($uncallChamber) { $uncallChamber.on('click', onUncallChamber); }
-
-    pageRefresh = setInterval(refreshPage, 10000);
 }
 
 var onAPClick = function(e) {
     var reportingunit = $(this).data('reportingunit') !== 'None' ? $(this).data('reportingunit') : ''
 
-    console.log(reportingunit);
     var data = {
         race_id: $(this).data('race-id'),
         statepostal: $(this).data('statepostal'),
@@ -52,9 +99,7 @@ var onAPClick = function(e) {
     }
 
     $overlay.fadeIn();
-    $.post(ACCEPT_AP_URL, data,function() {
-        refreshPage(true);
-    });
+    $.post(ACCEPT_AP_URL, data, patchRaces);
 }
 
 var onCallNPRClick = function(e) {
@@ -64,9 +109,7 @@ var onCallNPRClick = function(e) {
     }
 
     $overlay.fadeIn();
-    $.post(CALL_NPR_URL, data, function() {
-        refreshPage(true);
-    });
+    $.post(CALL_NPR_URL, data, patchRaces);
 }
 
 var onUncallNPRClick = function(e) {
@@ -76,9 +119,7 @@ var onUncallNPRClick = function(e) {
     }
 
     $overlay.fadeIn();
-    $.post(CALL_NPR_URL, data, function() {
-        refreshPage(true);
-    });
+    $.post(CALL_NPR_URL, data, patchRaces);
 }
 
 var onAllowChamberCall = function(e) {
@@ -92,7 +133,7 @@ var callChamber = function(party) {
 
     $overlay.fadeIn();
     $.post(CHAMBER_CALL_URL, data, function() {
-        refreshPage(true);
+        refreshPage();
     });
 }
 
@@ -100,20 +141,56 @@ var onUncallChamber = function(e) { callChamber(null); }
 var onCallChamberDem = function(e) { callChamber('Dem'); }
 var onCallChamberGOP = function(e) { callChamber('GOP'); }
 
+// Calls respond with the new markup for their race
+var patchRaces = function(data) {
+    $.each(data.races, function(raceId, html) {
+        $container.find('.race[data-race-id="' + raceId + '"]').html(html);
+    });
+    $overlay.fadeOut();
+}
+
+var refreshRaces = function(retryIfUnchanged) {
+    $.getJSON(CHANGES_URL, { since: version }, function(data) {
+        // The chamber-call controls sit outside of the races, so
+        // redraw everything if they changed
+        if ((data.chamber_call_override || null) !== chamberCallOverride) {
+            refreshPage();
+            return;
+        }
+
+        var missingRace = false;
+        $.each(data.races, function(raceId, html) {
+            var $race = $container.find('.race[data-race-id="' + raceId + '"]');
+            if ($race.length) {
+                $race.html(html);
+            } else {
+                missingRace = true;
+            }
+        });
+
+        if (missingRace) {
+            refreshPage();
+            return;
+        }
+
+        // A call is announced as soon as it's made, so its changes
+        // could still be on their way to this worker's results
+        if (retryIfUnchanged && data.version === version) {
+            clearTimeout(eventRefreshTimer);
+            eventRefreshTimer = setTimeout(function() { refreshRaces(); }, CALL_EVENT_RETRY_DELAY);
+        }
+
+        version = data.version;
+        $overlay.fadeOut();
+    });
+}
+
 var refreshPage = function() {
     $.get(window.location.href, function(data) {
-        var $oldContainer = $('.container');
-        var $newHTML = $(data);
-        var $newContainer = $newHTML.filter('.container');
-        $oldContainer.html($newContainer);
-
-        $acceptAP.off('click');
-        $rejectAP.off('click');
-        $callNPR.off('click');
-        $uncallNPR.off('click');
-        clearInterval(pageRefresh);
-
-        onDocumentLoad();
+        var $newContainer = $(data).filter('.container');
+        $container.replaceWith($newContainer);
+
+        bindContainer();
 
         $overlay.fadeOut();
     });